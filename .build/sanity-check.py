@@ -8,6 +8,8 @@ import difflib
 # TODO: we could get the list from .gitignore
 IGNORE_LIST = [
     '.ipynb_checkpoints',
+    '__pycache__',
+    'handbook_utils',
 ]
 
 folder1, folder2 = sys.argv[1:3]
@@ -0,0 +1,249 @@
+"""
+Helpers shared by several notebooks of the handbook.
+
+The notebooks import them from this file, which must be next to them: in
+Google Colab, download it with the commented cell at the top of the notebooks.
+"""
+import html
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+import psutil
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+
+import clinicadl.utils.network as network_package
+from clinicadl.prepare_data.prepare_data_utils import compute_discarded_slices
+
+
+def load_network(maps_manager, split=0, selection_metric="loss", network=None, gpu=False):
+    """
+    Builds a network of a MAPS and loads the weights selected on selection_metric.
+    :param maps_manager: (MapsManager) manager of the MAPS.
+    :param network: (int) index of the network (only used in multi-network setting).
+    :param gpu: (bool) if True the network is loaded on GPU.
+    :return: (Network) the network in evaluation mode.
+    """
+    model_class = getattr(network_package, maps_manager.architecture)
+    init_code = model_class.__init__.__code__
+    kwargs = {
+        arg: maps_manager.parameters[arg]
+        for arg in init_code.co_varnames[1:init_code.co_argcount]
+    }
+    kwargs["gpu"] = gpu
+    model = model_class(**kwargs)
+    state = maps_manager.get_state_dict(
+        split, selection_metric, network=network, map_location=model.device
+    )
+    model.load_state_dict(state["model"])
+    return model.eval()
+
+
+def extract_all_locations(image, preprocessing_dict):
+    """
+    Extracts all the slices or patches of an image in a single tensor.
+    :param image: (Tensor) image of size (1, D, H, W).
+    :param preprocessing_dict: (dict) content of the JSON file written by prepare-data.
+    :return: (Tensor) tensor of size (n_locations, C, ...), ordered as the location indices of ClinicaDL.
+    """
+    mode = preprocessing_dict["mode"]
+    if mode == "patch":
+        size = preprocessing_dict["patch_size"]
+        stride = preprocessing_dict["stride_size"]
+        patches = image.unfold(1, size, stride).unfold(2, size, stride).unfold(3, size, stride)
+        return patches.reshape(-1, 1, size, size, size)
+    elif mode == "slice":
+        direction = preprocessing_dict["slice_direction"]
+        begin, end = compute_discarded_slices(preprocessing_dict["discarded_slices"])
+        slices = image.narrow(direction + 1, begin, image.size(direction + 1) - begin - end)
+        slices = slices.movedim(direction + 1, 0)
+        if preprocessing_dict["slice_mode"] == "rgb":
+            slices = slices.expand(-1, 3, -1, -1)
+        if preprocessing_dict.get("num_slices") is not None:
+            slices = slices[:preprocessing_dict["num_slices"]]
+        return slices
+    elif mode == "image":
+        return image.unsqueeze(0)
+    else:
+        raise NotImplementedError(f"Extraction of all locations is not implemented for mode {mode}.")
+
+
+class AllLocationsDataset(Dataset):
+    """
+    Wraps a CapsDataset in image mode: each sample contains all the locations
+    of one image, extracted after a single read of the image tensor.
+    """
+    def __init__(self, image_dataset, preprocessing_dict, all_transformations=None, train_transformations=None):
+        self.image_dataset = image_dataset
+        self.preprocessing_dict = preprocessing_dict
+        self.all_transformations = all_transformations
+        self.train_transformations = train_transformations
+        self.eval_mode = False
+
+    def __len__(self):
+        return len(self.image_dataset)
+
+    def __getitem__(self, idx):
+        sample = self.image_dataset[idx]
+        locations = []
+        for location in extract_all_locations(sample["image"], self.preprocessing_dict):
+            if self.all_transformations:
+                location = self.all_transformations(location)
+            if self.train_transformations and not self.eval_mode:
+                location = self.train_transformations(location)
+            locations.append(location)
+        sample["image"] = torch.stack(locations)
+        return sample
+
+    def train(self):
+        self.eval_mode = False
+        return self
+
+    def eval(self):
+        self.eval_mode = True
+        return self
+
+
+def autocast_context(device, amp=False):
+    """Autocast context in float16 on GPU and in bfloat16 on CPU."""
+    if not amp:
+        return nullcontext()
+    if torch.device(device).type == "cuda":
+        return torch.autocast("cuda", dtype=torch.float16)
+    return torch.autocast("cpu", dtype=torch.bfloat16)
+
+
+class PeakMemory:
+    """
+    Measures the peak memory used by the code run in its context, in MiB.
+    On GPU, the memory allocated by PyTorch is measured. On CPU, the resident
+    memory of the process is sampled in a thread.
+    """
+    def __init__(self, device="cpu", interval=0.01):
+        self.device = torch.device(device)
+        self.interval = interval
+        self.peak = 0
+
+    def _sample(self):
+        process = psutil.Process()
+        while not self._stop.wait(self.interval):
+            self._max_rss = max(self._max_rss, process.memory_info().rss)
+
+    def __enter__(self):
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self._start = torch.cuda.memory_allocated(self.device)
+        else:
+            self._start = self._max_rss = psutil.Process().memory_info().rss
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        if self.device.type == "cuda":
+            peak = torch.cuda.max_memory_allocated(self.device)
+        else:
+            self._stop.set()
+            self._thread.join()
+            peak = max(self._max_rss, psutil.Process().memory_info().rss)
+        self.peak = (peak - self._start) / 2 ** 20
+
+
+def orthogonal_slices(image_path):
+    """
+    Extracts the three central orthogonal slices of a volume, without loading the rest of it.
+    :param image_path: (str) path to a NIfTI image or a tensor of size ([C,] D, H, W).
+    :return: (list[ndarray]) the sagittal, coronal and axial slices.
+    """
+    image_path = str(image_path)
+    if image_path.endswith(".pt"):
+        # the tensor is memory-mapped, only the pages of the slices are read
+        volume = torch.load(image_path, mmap=True)
+        volume = volume[0] if volume.dim() == 4 else volume
+    else:
+        # the slices of an uncompressed NIfTI are read from a memory map
+        volume = nib.load(image_path, mmap=True).dataobj
+    x, y, z = (size // 2 for size in volume.shape[:3])
+    return [np.asarray(volume[x, :, :]), np.asarray(volume[:, y, :]), np.asarray(volume[:, :, z])]
+
+
+def to_rgb(values, cmap="gray"):
+    """
+    Converts slices to RGB arrays.
+    :param cmap: (str) gray, scaled between the 1st and 99th percentiles, or diverging, blue for negative and red for
+        positive values.
+    """
+    values = [v.astype(np.float32) for v in values]
+    all_values = np.concatenate([v.ravel() for v in values])
+    if cmap == "gray":
+        vmin, vmax = np.percentile(all_values, [1, 99])
+        scaled = [np.clip((v - vmin) / max(vmax - vmin, 1e-12), 0, 1) for v in values]
+        return [np.stack([s] * 3, axis=-1) for s in scaled]
+    vmax = max(np.abs(all_values).max(), 1e-12)
+    scaled = [v / vmax for v in values]
+    return [np.stack([np.minimum(1, 1 + s), 1 - np.abs(s), np.minimum(1, 1 - s)], axis=-1) for s in scaled]
+
+
+def render_thumbnail(image_path, png_path, cmap="gray", height=128):
+    """Writes the three central orthogonal slices of a volume side by side in a PNG file."""
+    tiles = []
+    for rgb in to_rgb(orthogonal_slices(image_path), cmap):
+        # neurological orientation: superior or anterior up
+        tile = Image.fromarray((np.rot90(rgb) * 255).astype(np.uint8))
+        tiles.append(tile.resize((max(1, round(tile.width * height / tile.height)), height), Image.BILINEAR))
+    thumbnail = Image.new("RGB", (sum(tile.width for tile in tiles), height))
+    left = 0
+    for tile in tiles:
+        thumbnail.paste(tile, (left, 0))
+        left += tile.width
+    thumbnail.save(png_path)
+    return png_path
+
+
+def render_contact_sheet(images_df, output_dir, cmap="gray", height=128, n_proc=4, captions=()):
+    """
+    Renders the thumbnails of a list of volumes in a process pool, and an HTML contact sheet showing all of them.
+    :param images_df: (DataFrame) with the participant_id, session_id and path of each volume, in the order of the
+        sheet, and a mode_id column (e.g. slice-3) when a session has several volumes.
+    :param output_dir: (str) folder of the thumbnails and of index.html.
+    :param captions: (list[str]) other columns of images_df shown under the thumbnails.
+    :return: (Path) the path to the contact sheet.
+    """
+    output_dir = Path(output_dir)
+    (output_dir / "thumbnails").mkdir(parents=True, exist_ok=True)
+    id_columns = [c for c in ["participant_id", "session_id", "mode_id"] if c in images_df.columns]
+    names = ["_".join(str(getattr(row, c)) for c in id_columns) for row in images_df.itertuples()]
+    png_paths = [output_dir / "thumbnails" / f"{name}.png" for name in names]
+    with ProcessPoolExecutor(n_proc) as executor:
+        list(
+            executor.map(
+                render_thumbnail,
+                images_df.path,
+                png_paths,
+                [cmap] * len(png_paths),
+                [height] * len(png_paths),
+                chunksize=max(1, len(png_paths) // (4 * n_proc)),
+            )
+        )
+
+    figures = []
+    for row, png_path in zip(images_df.itertuples(), png_paths):
+        caption = " ".join([str(getattr(row, c)) for c in id_columns] + [f"{c}={getattr(row, c)}" for c in captions])
+        figures.append(
+            f'<figure><img src="thumbnails/{html.escape(png_path.name)}" loading="lazy">'
+            f"<figcaption>{html.escape(caption)}</figcaption></figure>"
+        )
+    sheet_path = output_dir / "index.html"
+    sheet_path.write_text(
+        "<html><head><style>"
+        "body{display:flex;flex-wrap:wrap;font-family:sans-serif;font-size:12px;background:#222;color:#eee}"
+        "figure{margin:4px}"
+        "</style></head><body>\n" + "\n".join(figures) + "\n</body></html>"
+    )
+    return sheet_path
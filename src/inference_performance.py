@@ -0,0 +1,2166 @@
+# -*- coding: utf-8 -*-
+# ---
+# jupyter:
+#   jupytext:
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.5'
+#       jupytext_version: 1.13.3
+#   kernelspec:
+#     display_name: Python 3
+#     name: python3
+# ---
+
+# %%
+# Uncomment this cell if running in Google Colab
+# !pip install clinicadl==1.6.1
+# !curl -k https://raw.githubusercontent.com/aramis-lab/clinicadl_handbook/main/notebooks/handbook_utils.py -o handbook_utils.py
+
+# %% [markdown]
+# # Speed up the inference
+#
+# `clinicadl predict` is designed to evaluate a MAPS on a data group in a
+# reproducible way: it checks the data group, reads the data, rebuilds the
+# networks and writes all the outputs in the MAPS. When many sessions must be
+# scored, or when the same sessions are scored by many models, most of the
+# time is spent in reading the same images again and again.
+#
+# This notebook gathers recipes, built on top of the ClinicaDL API, to reduce
+# this time. They rely on the MAPS trained in the
+# [classification notebook](./training_classification.ipynb). If you did not
+# run it, uncomment the next cell to download the MAPS, the CAPS and the
+# splits.
+
+# %%
+# !curl -k https://aramislab.paris.inria.fr/clinicadl/files/handbook_2023/data_oasis/maps_classification_2D_slice_multi.tar.gz -o maps_classification_2D_slice_multi.tar.gz
+# !tar xf maps_classification_2D_slice_multi.tar.gz
+# !curl -k https://aramislab.paris.inria.fr/clinicadl/files/handbook_2023/data_oasis/CAPS_example_prepared.tar.gz -o oasisCaps.tar.gz
+# !tar xf oasisCaps.tar.gz
+# !curl -k https://aramislab.paris.inria.fr/clinicadl/files/handbook_2023/data_oasis/split.tar.gz -o training_split.tar.gz
+# !tar xf training_split.tar.gz
+
+# %%
+import torch
+
+# Check if a GPU is available
+gpu = torch.cuda.is_available()
+print('GPU is available: ', gpu)
+
+# %% [markdown]
+# ## Load the networks of a MAPS
+#
+# The `MapsManager` class is the object used by `clinicadl` to read and write
+# in a MAPS. It gives access to the training parameters (stored in
+# `maps.json`) and to the weights of the selected networks. The `load_network`
+# function builds the network from these parameters, in the same way as
+# `clinicadl predict`, and loads its weights. As other helpers used by several
+# notebooks, it is defined in `handbook_utils.py`, next to the notebooks.
+
+# %%
+from pathlib import Path
+
+from clinicadl import MapsManager
+from handbook_utils import load_network
+
+
+# %% [markdown]
+# ## Multi-network prediction in one pass
+#
+# For a multi-network MAPS, `clinicadl predict` evaluates the networks one
+# after the other: the data group is read once for each network, then the
+# image-level result is computed by soft-voting from the TSV files written for
+# each network.
+#
+# All the networks can instead be loaded once, and each image read once: its
+# slices (or patches) are extracted from memory and each location is given to
+# its network. The per-location outputs and the soft-voting are then computed
+# on the same batch.
+#
+# The `AllLocationsDataset` of `handbook_utils.py`, also used in the
+# [speed up the training](./training_performance.ipynb) notebook, returns for
+# each session all its locations in a single tensor. As in ClinicaDL, the
+# transformations (for example the min-max normalization) are applied to each
+# location after its extraction.
+
+# %%
+from torch.utils.data import Dataset
+
+from clinicadl.prepare_data.prepare_data_utils import compute_discarded_slices
+from clinicadl.utils.caps_dataset.data import CapsDatasetImage, get_transforms
+from handbook_utils import AllLocationsDataset, extract_all_locations
+
+
+def location_ids(preprocessing_dict, n_locations):
+    """Returns the indices written by ClinicaDL in the <mode>_id column."""
+    if preprocessing_dict["mode"] == "slice":
+        begin, _ = compute_discarded_slices(preprocessing_dict["discarded_slices"])
+        return list(range(begin, begin + n_locations))
+    return list(range(n_locations))
+
+
+def get_locations_dataset(maps_manager, caps_directory, group_df, use_labels=True):
+    """Builds the dataset of all locations with the preprocessing and transformations of the MAPS."""
+    _, all_transforms = get_transforms(
+        normalize=maps_manager.normalize,
+        size_reduction=maps_manager.size_reduction,
+        size_reduction_factor=maps_manager.size_reduction_factor,
+    )
+    image_dataset = CapsDatasetImage(
+        Path(caps_directory),
+        group_df,
+        maps_manager.preprocessing_dict,
+        label_presence=use_labels,
+        label=maps_manager.label,
+        label_code=maps_manager.label_code,
+    )
+    return AllLocationsDataset(image_dataset, maps_manager.preprocessing_dict, all_transforms)
+
+
+# %% [markdown]
+# The networks can be evaluated in half precision: `float16` on GPU, as with
+# `clinicadl predict --amp`, and `bfloat16` on CPU (see the
+# [speed up the training](./training_performance.ipynb) notebook).
+
+# %%
+from handbook_utils import autocast_context
+
+
+# %% [markdown]
+# The weights of the soft-voting are computed as in `clinicadl predict`: the
+# weight of a location is its accuracy on the validation set (locations with
+# an accuracy lower than `selection_threshold` are discarded). They are read
+# from the validation predictions written in the MAPS at the end of the
+# training.
+
+# %%
+def validation_accuracies(maps_manager, split=0, selection_metric="loss"):
+    """
+    Computes the accuracy of each location on the validation set.
+    :return: (Series) accuracies ordered by location index.
+    """
+    mode_id = f"{maps_manager.mode}_id"
+    validation_df = maps_manager.get_prediction(
+        "validation", split, selection_metric, maps_manager.mode
+    ).reset_index()
+    accurate = validation_df.true_label == validation_df.predicted_label
+    return accurate.groupby(validation_df[mode_id]).mean().sort_index()
+
+
+def soft_voting_weights(maps_manager, split=0, selection_metric="loss"):
+    """
+    Computes the weight of each location in the soft-voting.
+    :return: (Tensor) weights ordered by location index, summing to 1.
+    """
+    accuracies = validation_accuracies(maps_manager, split, selection_metric)
+    if maps_manager.selection_threshold is not None:
+        accuracies[accuracies < maps_manager.selection_threshold] = 0
+    return torch.tensor((accuracies / accuracies.sum()).values, dtype=torch.float32)
+
+
+# %% [markdown]
+# The prediction writes its outputs with the same names as `clinicadl
+# predict`, in `split-<i>/best-<metric>/<data_group>`:
+# - `<data_group>_<mode>_level_prediction.tsv` with the output of each
+# network,
+# - `<data_group>_image_level_prediction.tsv` and
+# `<data_group>_image_level_metrics.tsv` with the soft-voting results.
+#
+# ```{warning}
+# Contrary to `clinicadl predict`, this function does not register the data
+# group in the MAPS and does not check for data leakage between the training
+# set and the participants given.
+# ```
+
+# %%
+from functools import partial
+
+import pandas as pd
+from torch.nn.functional import softmax
+from torch.utils.data import DataLoader
+
+from clinicadl.utils.caps_dataset.data import load_data_test
+
+
+def write_predictions(maps_manager, data_group, split, selection_metric, level, prediction_df, metrics=None):
+    """Writes predictions (and metrics) with the file names used by clinicadl predict."""
+    performance_dir = (
+        maps_manager.maps_path / f"split-{split}" / f"best-{selection_metric}" / data_group
+    )
+    performance_dir.mkdir(parents=True, exist_ok=True)
+    prediction_df.to_csv(
+        performance_dir / f"{data_group}_{level}_level_prediction.tsv", sep="\t", index=False
+    )
+    if metrics is not None:
+        pd.DataFrame(metrics, index=[0]).to_csv(
+            performance_dir / f"{data_group}_{level}_level_metrics.tsv", sep="\t", index=False
+        )
+
+
+def predict_multi_network(
+    maps_manager,
+    data_group,
+    caps_directory,
+    participants_tsv,
+    split=0,
+    selection_metric="loss",
+    batch_size=8,
+    n_proc=2,
+    gpu=False,
+    use_labels=True,
+    amp=False,
+    scripted=False,
+    quantized=False,
+):
+    """
+    Predicts the outputs of all the networks of a multi-network MAPS and the soft-voting in one pass.
+    :param amp: (bool) if True the networks are evaluated in float16 on GPU and bfloat16 on CPU.
+    :param scripted: (bool) if True the networks exported with TorchScript are used.
+    :param quantized: (bool) if True the int8 networks exported with export_quantized are used, on CPU.
+    :return: (DataFrame, DataFrame) the predictions at the location and at the image levels.
+    """
+    mode = maps_manager.mode
+    group_df = load_data_test(Path(participants_tsv), maps_manager.diagnoses)
+    dataset = get_locations_dataset(maps_manager, caps_directory, group_df, use_labels=use_labels)
+    gpu = gpu and not quantized
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=n_proc, pin_memory=gpu)
+
+    load_function = load_network
+    if scripted or quantized:
+        load_function = partial(load_scripted_network, quantized=quantized)
+    networks = [
+        load_function(maps_manager, split, selection_metric, network=network, gpu=gpu)
+        for network in range(maps_manager.num_networks)
+    ]
+    default_device = "cuda" if gpu else "cpu"
+    weights = soft_voting_weights(maps_manager, split, selection_metric)
+    ids = location_ids(maps_manager.preprocessing_dict, maps_manager.num_networks)
+
+    columns = maps_manager.task_manager.columns
+    mode_rows, image_rows = [], []
+    with torch.no_grad():
+        for data in loader:
+            # probas has size (batch_size, n_networks, n_classes)
+            outputs = []
+            for i, network in enumerate(networks):
+                device = getattr(network, "device", default_device)
+                with autocast_context(device, amp):
+                    output = network(data["image"][:, i].to(device))
+                outputs.append(softmax(output.float(), dim=1).cpu())
+            probas = torch.stack(outputs, dim=1)
+            image_probas = torch.einsum("bnc,n->bc", probas, weights)
+            labels = data["label"] if use_labels else torch.full((len(probas),), -1)
+            for idx in range(len(probas)):
+                participant_id, session_id = data["participant_id"][idx], data["session_id"][idx]
+                label = labels[idx].item()
+                for i, location_id in enumerate(ids):
+                    mode_rows.append(
+                        [participant_id, session_id, location_id, label, probas[idx, i].argmax().item()]
+                        + probas[idx, i].tolist()
+                    )
+                image_rows.append(
+                    [participant_id, session_id, 0, label, image_probas[idx].argmax().item()]
+                    + image_probas[idx].tolist()
+                )
+
+    mode_df = pd.DataFrame(mode_rows, columns=columns)
+    image_df = pd.DataFrame(image_rows, columns=columns)
+    metrics = maps_manager.task_manager.compute_metrics(image_df, report_ci=False) if use_labels else None
+    write_predictions(maps_manager, data_group, split, selection_metric, mode, mode_df)
+    write_predictions(maps_manager, data_group, split, selection_metric, "image", image_df, metrics)
+    return mode_df, image_df
+
+
+# %% [markdown]
+# The next cell evaluates the 2D slice-level multi-CNN on the test set, as
+# `clinicadl predict data_oasis/maps_classification_2D_slice_multi 'test-Oasis' ...`
+# does in the [classification notebook](./training_classification.ipynb).
+
+# %%
+maps_manager = MapsManager(Path("data_oasis/maps_classification_2D_slice_multi"))
+slice_df, image_df = predict_multi_network(
+    maps_manager,
+    "test-Oasis-grouped",
+    "data_oasis/CAPS_example",
+    "data_oasis/split/test_baseline.tsv",
+    gpu=gpu,
+)
+image_df.head()
+
+# %% [markdown]
+# ```{note}
+# This recipe is written for the `classification` task, in which the
+# soft-voting is defined. The whole images are read, so the tensors of the
+# slices or patches saved by `prepare-data` with `--save-features` are not
+# needed.
+# ```
+
+# %% [markdown]
+# ## Export the networks with TorchScript
+#
+# Each call to `clinicadl predict` builds the networks from the parameters of
+# the MAPS and loads their weights. The networks can instead be exported once
+# with [TorchScript](https://pytorch.org/docs/stable/jit.html): the exported
+# file contains the architecture and the weights, and can be loaded without
+# building the network (or even without ClinicaDL, for example in a scoring
+# service).
+#
+# The network is traced on an input of the size used during the training, then
+# frozen: the weights become constants, which allows PyTorch to optimize the
+# graph (for example by fusing the batch normalizations in the convolutions).
+# The exported files are written next to the weights of each selection metric,
+# in `split-<i>/best-<metric>/model.pt` (or `network-<j>_model.pt` for a
+# multi-network).
+
+# %%
+import json
+import warnings
+
+from torch import nn
+
+
+class Predictor(nn.Module):
+    """Exposes the predict method of a ClinicaDL network as its forward method."""
+    def __init__(self, network):
+        super().__init__()
+        self.network = network
+
+    def forward(self, x):
+        return self.network.predict(x)
+
+
+def scripted_model_path(maps_manager, split=0, selection_metric="loss", network=None, quantized=False):
+    """Path of the TorchScript file of a network of the MAPS."""
+    best_dir = maps_manager.maps_path / f"split-{split}" / f"best-{selection_metric}"
+    file_name = "model_int8.pt" if quantized else "model.pt"
+    return best_dir / (file_name if network is None else f"network-{network}_{file_name}")
+
+
+def export_torchscript(maps_manager, split=0, selection_metrics=None):
+    """
+    Exports the networks of a split with TorchScript.
+    :param maps_manager: (MapsManager) manager of the MAPS.
+    :param selection_metrics: (list[str]) selection metrics exported, by default all the ones of the MAPS.
+    :return: (list[Path]) paths of the exported files.
+    """
+    if selection_metrics is None:
+        selection_metrics = maps_manager.selection_metrics
+    networks = range(maps_manager.num_networks) if maps_manager.multi_network else [None]
+    example = torch.zeros([1] + maps_manager.input_size)
+
+    paths = []
+    for selection_metric in selection_metrics:
+        for network in networks:
+            model = load_network(maps_manager, split, selection_metric, network=network)
+            with torch.no_grad(), warnings.catch_warnings():
+                # The padding of the pooling layers depends on the input size, which is fixed
+                warnings.simplefilter("ignore", torch.jit.TracerWarning)
+                traced = torch.jit.trace(Predictor(model).eval(), example)
+            path = scripted_model_path(maps_manager, split, selection_metric, network)
+            torch.jit.save(
+                torch.jit.freeze(traced),
+                path,
+                _extra_files={"maps.json": json.dumps({
+                    "architecture": maps_manager.architecture,
+                    "input_size": maps_manager.input_size,
+                    "network": network,
+                })},
+            )
+            paths.append(path)
+    return paths
+
+
+def load_scripted_network(maps_manager, split=0, selection_metric="loss", network=None, gpu=False, quantized=False):
+    """
+    Loads a network exported with export_torchscript, or with export_quantized if quantized is True.
+    :return: (ScriptModule) the network, in evaluation mode.
+    """
+    return torch.jit.load(
+        scripted_model_path(maps_manager, split, selection_metric, network, quantized),
+        map_location="cuda" if gpu else "cpu",
+    )
+
+
+# %% [markdown]
+# The following function predicts the outputs of a single-network MAPS with
+# the exported network, or with the network built by ClinicaDL. As
+# `clinicadl predict`, it writes the predictions at the level of the mode of
+# the MAPS, and for slices and patches the image-level soft-voting computed by
+# the task manager.
+
+# %%
+from clinicadl.utils.caps_dataset.data import return_dataset
+
+
+def predict_network(
+    maps_manager,
+    data_group,
+    caps_directory,
+    participants_tsv,
+    split=0,
+    selection_metric="loss",
+    batch_size=8,
+    n_proc=2,
+    gpu=False,
+    use_labels=True,
+    scripted=False,
+    quantized=False,
+):
+    """
+    Predicts the outputs of a single-network MAPS.
+    :param scripted: (bool) if True the network exported with TorchScript is used.
+    :param quantized: (bool) if True the int8 network exported with export_quantized is used, on CPU.
+    :return: (DataFrame) the predictions at the level of the mode of the MAPS.
+    """
+    mode = maps_manager.mode
+    task_manager = maps_manager.task_manager
+    group_df = load_data_test(Path(participants_tsv), maps_manager.diagnoses)
+    _, all_transforms = get_transforms(
+        normalize=maps_manager.normalize,
+        size_reduction=maps_manager.size_reduction,
+        size_reduction_factor=maps_manager.size_reduction_factor,
+    )
+    dataset = return_dataset(
+        Path(caps_directory),
+        group_df,
+        maps_manager.preprocessing_dict,
+        all_transformations=all_transforms,
+        label=maps_manager.label,
+        label_code=maps_manager.label_code,
+        label_presence=use_labels,
+    )
+    gpu = gpu and not quantized
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=n_proc, pin_memory=gpu)
+
+    if scripted or quantized:
+        predict = load_scripted_network(maps_manager, split, selection_metric, gpu=gpu, quantized=quantized)
+        device = "cuda" if gpu else "cpu"
+    else:
+        model = load_network(maps_manager, split, selection_metric, gpu=gpu)
+        predict, device = model.predict, model.device
+
+    rows = []
+    with torch.no_grad():
+        for data in loader:
+            outputs = predict(data["image"].to(device)).float().cpu()
+            for idx in range(len(outputs)):
+                rows += task_manager.generate_test_row(idx, data, outputs)
+
+    mode_df = pd.DataFrame(rows, columns=task_manager.columns)
+    metrics = task_manager.compute_metrics(mode_df, report_ci=False) if use_labels else None
+    write_predictions(maps_manager, data_group, split, selection_metric, mode, mode_df, metrics)
+    if mode != "image" and maps_manager.network_task == "classification":
+        validation_df = maps_manager.get_prediction("validation", split, selection_metric, mode)
+        image_df, image_metrics = task_manager.ensemble_prediction(
+            mode_df.copy(),
+            validation_df.reset_index(),
+            selection_threshold=maps_manager.selection_threshold,
+            use_labels=use_labels,
+        )
+        write_predictions(maps_manager, data_group, split, selection_metric, "image", image_df, image_metrics)
+    return mode_df
+
+
+# %% [markdown]
+# The next cell exports the 2D slice-level CNN of the
+# [classification notebook](./training_classification.ipynb), then compares
+# the time needed to load the network and to predict the test set with the
+# network built by ClinicaDL and with the exported network.
+
+# %%
+from time import perf_counter
+
+maps_manager = MapsManager(Path("data_oasis/maps_classification_2D_slice_resnet18"))
+export_torchscript(maps_manager)
+
+timings = []
+for scripted in [False, True]:
+    start = perf_counter()
+    model = load_scripted_network(maps_manager) if scripted else load_network(maps_manager)
+    load_time = perf_counter() - start
+    start = perf_counter()
+    slice_df = predict_network(
+        maps_manager,
+        "test-Oasis-scripted" if scripted else "test-Oasis-eager",
+        "data_oasis/CAPS_example",
+        "data_oasis/split/test_baseline.tsv",
+        gpu=gpu,
+        scripted=scripted,
+    )
+    timings.append({
+        "scripted": scripted,
+        "load_time": load_time,
+        "predict_time": perf_counter() - start,
+        "balanced_accuracy": maps_manager.task_manager.compute_metrics(slice_df, report_ci=False)["BA"],
+    })
+pd.DataFrame(timings)
+
+# %% [markdown]
+# ```{note}
+# The traced network only accepts inputs of the size of the MAPS
+# (`input_size` in `maps.json`), which is always the case for the data
+# prepared with the same `prepare-data` options. As the weights are fused
+# during the freezing, the outputs may differ from the ones of the original
+# network by rounding errors.
+#
+# Recent versions of PyTorch recommend `torch.export` instead of TorchScript
+# to export a network. The same principle applies: the exported program is
+# written once per selection metric and loaded in place of the network.
+# ```
+
+# %% [markdown]
+# ## Serve the predictions
+#
+# When sessions are scored as they arrive, for example at the end of a
+# clinical pipeline, most of the time of `clinicadl predict` is spent before
+# the prediction itself: importing the libraries, building the networks and
+# loading their weights. A prediction service avoids this cost by keeping the
+# networks in memory between the requests.
+#
+# The service below answers HTTP requests. It is built on the functions of the
+# previous sections:
+# - a `ResidentModel` keeps the networks of a MAPS in memory (built by
+# ClinicaDL or exported with TorchScript), with the soft-voting weights of
+# the slices or patches,
+# - a `MicroBatcher` gathers the sessions sent by concurrent requests during a
+# few milliseconds, to predict them in a single batch,
+# - the HTTP server lists the models on `GET /models` and predicts the
+# sessions posted on `POST /predict`.
+#
+# The service returns the same fields as `<data_group>_image_level_prediction.tsv`.
+# As the labels of the sessions are unknown, `true_label` is empty.
+
+# %%
+class ResidentModel:
+    """A classification MAPS kept in memory to predict sessions of a CAPS."""
+    def __init__(self, maps_path, caps_directory, split=0, selection_metric="loss", gpu=False, scripted=False):
+        self.maps_manager = MapsManager(Path(maps_path))
+        if self.maps_manager.network_task != "classification":
+            raise NotImplementedError("The prediction service is only implemented for classification.")
+        self.caps_directory = Path(caps_directory)
+        self.preprocessing_dict = self.maps_manager.preprocessing_dict
+        _, self.transforms = get_transforms(
+            normalize=self.maps_manager.normalize,
+            size_reduction=self.maps_manager.size_reduction,
+            size_reduction_factor=self.maps_manager.size_reduction_factor,
+        )
+
+        load_function = load_scripted_network if scripted else load_network
+        network_indices = range(self.maps_manager.num_networks) if self.maps_manager.multi_network else [None]
+        self.networks = [
+            load_function(self.maps_manager, split, selection_metric, network=network, gpu=gpu)
+            for network in network_indices
+        ]
+        self.device = "cuda" if gpu else "cpu"
+        if self.maps_manager.mode == "image":
+            self.weights = torch.ones(1)
+        else:
+            self.weights = soft_voting_weights(self.maps_manager, split, selection_metric)
+
+    def read_images(self, sessions):
+        """Reads the image tensors of the sessions, before the extraction of the locations."""
+        df = pd.DataFrame(sessions)[["participant_id", "session_id"]].assign(cohort="single")
+        image_dataset = CapsDatasetImage(
+            self.caps_directory, df, self.preprocessing_dict, label_presence=False
+        )
+        return [image_dataset[idx]["image"] for idx in range(len(image_dataset))]
+
+    def compute_logits(self, images):
+        """
+        Computes the outputs of the networks, before the softmax, on image tensors read by read_images.
+        :param images: (list[Tensor]) image tensors of size (1, D, H, W).
+        :return: (Tensor) the outputs of each location, of size (n_images, n_locations, n_classes).
+        """
+        locations = torch.stack([
+            torch.stack([
+                self.transforms(location) if self.transforms else location
+                for location in extract_all_locations(image, self.preprocessing_dict)
+            ])
+            for image in images
+        ])
+        n_images, n_locations = locations.shape[:2]
+        with torch.no_grad():
+            if len(self.networks) == 1:
+                network = self.networks[0]
+                device = getattr(network, "device", self.device)
+                outputs = network(locations.flatten(0, 1).to(device)).float()
+                return outputs.cpu().view(n_images, n_locations, -1)
+            return torch.stack(
+                [
+                    network(locations[:, i].to(getattr(network, "device", self.device))).float().cpu()
+                    for i, network in enumerate(self.networks)
+                ],
+                dim=1,
+            )
+
+    def predict_images(self, images):
+        """
+        Predicts image tensors read by read_images.
+        :param images: (list[Tensor]) image tensors of size (1, D, H, W).
+        :return: (Tensor, Tensor) the probabilities of each location, of size
+            (n_images, n_locations, n_classes), and of each image, of size (n_images, n_classes).
+        """
+        probas = softmax(self.compute_logits(images), dim=2)
+        return probas, torch.einsum("bnc,n->bc", probas, self.weights)
+
+    def predict(self, sessions):
+        """
+        Predicts a list of sessions.
+        :param sessions: (list[dict]) sessions with participant_id and session_id keys.
+        :return: (list[dict]) the image-level prediction of each session.
+        """
+        _, image_probas = self.predict_images(self.read_images(sessions))
+        columns = self.maps_manager.task_manager.columns
+        return [
+            dict(zip(
+                columns,
+                [session["participant_id"], session["session_id"], 0, None, image_proba.argmax().item()]
+                + image_proba.tolist(),
+            ))
+            for session, image_proba in zip(sessions, image_probas)
+        ]
+
+
+# %%
+import queue
+import threading
+from concurrent.futures import Future
+from time import perf_counter
+
+
+class MicroBatcher:
+    """Gathers the items submitted by concurrent requests in batches given to predict_function."""
+    def __init__(self, predict_function, max_batch_size=8, max_delay=0.01):
+        self.predict_function = predict_function
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        closed = False
+        while not closed:
+            request = self.queue.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = perf_counter() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self.queue.get(timeout=max(deadline - perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    closed = True
+                    break
+                batch.append(request)
+            self._predict(batch)
+
+    def _predict(self, batch):
+        items, futures = zip(*batch)
+        try:
+            results = self.predict_function(list(items))
+        except Exception as error:
+            if len(batch) == 1:
+                futures[0].set_exception(error)
+            else:
+                # An invalid item must only fail its own request
+                for request in batch:
+                    self._predict([request])
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+
+# %%
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET /models with the names of the models, and POST /predict with
+    the predictions of the sessions of the body:
+    {"maps": <name>, "sessions": [{"participant_id": ..., "session_id": ...}, ...]}
+    """
+    def _send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/models":
+            self._send_json(HTTPStatus.OK, list(self.server.batchers))
+        else:
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown path {self.path}."})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown path {self.path}."})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if not isinstance(request, dict):
+                raise ValueError("the body must be a JSON object")
+            batcher = self.server.batchers[request["maps"]]
+            sessions = request["sessions"]
+            if not isinstance(sessions, list) or not all(
+                isinstance(session, dict) and {"participant_id", "session_id"} <= session.keys()
+                for session in sessions
+            ):
+                raise ValueError("sessions must be a list of objects with participant_id and session_id")
+        except (ValueError, KeyError, TypeError) as error:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"error": f"Invalid request: {error!r}."})
+            return
+        futures = [batcher.submit(session) for session in sessions]
+        try:
+            predictions = [future.result() for future in futures]
+        except Exception as error:
+            self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": repr(error)})
+            return
+        self._send_json(HTTPStatus.OK, predictions)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_prediction_server(models, host="127.0.0.1", port=8000, max_batch_size=8, max_delay=0.01):
+    """
+    Starts the prediction service in a background thread.
+    :param models: (dict[str, ResidentModel]) models served, by name.
+    :param max_batch_size: (int) maximal number of sessions predicted together.
+    :param max_delay: (float) time in seconds during which sessions are gathered in a batch.
+    :return: (ThreadingHTTPServer) the server, to stop with stop_prediction_server.
+    """
+    server = ThreadingHTTPServer((host, port), PredictionHandler)
+    server.batchers = {
+        name: MicroBatcher(model.predict, max_batch_size=max_batch_size, max_delay=max_delay)
+        for name, model in models.items()
+    }
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stop_prediction_server(server):
+    server.shutdown()
+    server.server_close()
+    for batcher in server.batchers.values():
+        batcher.close()
+
+
+# %% [markdown]
+# The next cell starts the service with the two MAPS of the
+# [classification notebook](./training_classification.ipynb), then sends the
+# sessions of the test set as a client would do.
+
+# %%
+from urllib.request import Request, urlopen
+
+models = {
+    "slice_resnet18": ResidentModel("data_oasis/maps_classification_2D_slice_resnet18", "data_oasis/CAPS_example", gpu=gpu),
+    "slice_multi": ResidentModel("data_oasis/maps_classification_2D_slice_multi", "data_oasis/CAPS_example", gpu=gpu),
+}
+server = start_prediction_server(models, port=8000)
+
+test_df = pd.read_csv("data_oasis/split/test_baseline.tsv", sep="\t")
+request = {
+    "maps": "slice_multi",
+    "sessions": test_df[["participant_id", "session_id"]].to_dict("records"),
+}
+start = perf_counter()
+with urlopen(Request("http://127.0.0.1:8000/predict", data=json.dumps(request).encode())) as response:
+    predictions = pd.DataFrame(json.loads(response.read()))
+print(f"{len(predictions)} sessions predicted in {perf_counter() - start:.2f} s")
+predictions.head()
+
+# %%
+stop_prediction_server(server)
+
+# %% [markdown]
+# ```{note}
+# To run the service outside of a notebook, copy these cells in a script and
+# keep the main thread alive after `start_prediction_server` (or call
+# `server.serve_forever()` directly). The service listens on the local host
+# only: it does not implement any authentication, and should not be exposed on
+# a network.
+# ```
+
+# %% [markdown]
+# ## Ensemble of several MAPS in one pass
+#
+# To compare or combine several models (different input types, splits or
+# selection metrics), `clinicadl predict` must be run once per MAPS, and each
+# run reads the whole data group again. However, all these models are usually
+# trained on the same preprocessed images: the slices and patches are
+# extracted from the same image tensors.
+#
+# The following function reads each image once for each type of image tensor
+# (`preprocessing`, cropped or uncropped images), and gives it to all the
+# models which use it, with their own extraction and transformations. It uses
+# the `ResidentModel` of the previous section for every split and selection
+# metric of every MAPS, and writes:
+# - the predictions of each model in its MAPS, as in the previous sections,
+# - the image-level predictions of all the models in
+# `<data_group>_models_image_level_prediction.tsv`,
+# - the ensemble, which averages the probabilities of all the models, in
+# `<data_group>_ensemble_image_level_prediction.tsv`,
+# - the metrics of each model and of the ensemble in
+# `<data_group>_ensemble_image_level_metrics.tsv`.
+
+# %%
+def find_splits(maps_path):
+    """Lists the splits trained in a MAPS."""
+    return sorted(int(split_dir.name.split("-")[1]) for split_dir in Path(maps_path).glob("split-*"))
+
+
+def image_key(preprocessing_dict):
+    """Identifies the image tensors read for a preprocessing: models with the same key use the same images."""
+    return json.dumps([
+        preprocessing_dict["preprocessing"],
+        preprocessing_dict.get("use_uncropped_image", False),
+        preprocessing_dict["file_type"],
+    ], sort_keys=True)
+
+
+class SessionImagesDataset(Dataset):
+    """Reads the image tensors of a session once for each type of image needed by the models."""
+    def __init__(self, image_datasets):
+        self.image_datasets = image_datasets
+
+    def __len__(self):
+        return len(self.image_datasets[0])
+
+    def __getitem__(self, idx):
+        return [dataset[idx]["image"] for dataset in self.image_datasets]
+
+
+def collate_images(batch):
+    """Gathers the images of a batch by type of image."""
+    return [list(images) for images in zip(*batch)]
+
+
+def predict_ensemble(
+    maps_paths,
+    data_group,
+    caps_directory,
+    participants_tsv,
+    output_dir,
+    splits=None,
+    selection_metrics=None,
+    batch_size=8,
+    n_proc=2,
+    gpu=False,
+    use_labels=True,
+    scripted=False,
+):
+    """
+    Predicts the outputs of several classification MAPS, reading each image once.
+    :param maps_paths: (list[Path]) MAPS evaluated.
+    :param output_dir: (Path) directory in which the ensemble TSV files are written.
+    :param splits: (list[int]) splits evaluated, by default all the splits of each MAPS.
+    :param selection_metrics: (list[str]) selection metrics evaluated, by default all the ones of each MAPS.
+    :return: (DataFrame, DataFrame) the image-level predictions of each model and of the ensemble.
+    """
+    models = dict()
+    for maps_path in maps_paths:
+        maps_path = Path(maps_path)
+        for split in splits or find_splits(maps_path):
+            for selection_metric in selection_metrics or MapsManager(maps_path).selection_metrics:
+                model = ResidentModel(maps_path, caps_directory, split, selection_metric, gpu=gpu, scripted=scripted)
+                models[(maps_path.name, split, selection_metric)] = model
+
+    label_codes = {json.dumps(model.maps_manager.label_code, sort_keys=True) for model in models.values()}
+    if len(label_codes) > 1:
+        raise ValueError(f"The MAPS were trained with different label codes: {label_codes}.")
+    reference = next(iter(models.values())).maps_manager
+
+    # Models are grouped by the image tensors they read
+    group_df = load_data_test(Path(participants_tsv), reference.diagnoses)
+    image_groups = dict()
+    for name, model in models.items():
+        image_groups.setdefault(image_key(model.preprocessing_dict), []).append(name)
+    image_datasets = [
+        CapsDatasetImage(
+            Path(caps_directory), group_df, models[names[0]].preprocessing_dict, label_presence=False
+        )
+        for names in image_groups.values()
+    ]
+    loader = DataLoader(
+        SessionImagesDataset(image_datasets),
+        batch_size=batch_size,
+        num_workers=n_proc,
+        collate_fn=collate_images,
+    )
+
+    location_probas = {name: [] for name in models}
+    image_probas = {name: [] for name in models}
+    for batch in loader:
+        for images, names in zip(batch, image_groups.values()):
+            for name in names:
+                probas, image_proba = models[name].predict_images(images)
+                location_probas[name].append(probas)
+                image_probas[name].append(image_proba)
+
+    sessions_df = group_df[["participant_id", "session_id"]].reset_index(drop=True)
+    if use_labels:
+        sessions_df["true_label"] = group_df[reference.label].map(reference.label_code).values
+    else:
+        sessions_df["true_label"] = None
+    proba_columns = [f"proba{i}" for i in range(len(reference.label_code))]
+
+    def to_dataframe(probas, mode_id=0):
+        df = sessions_df.copy()
+        df.insert(2, f"{reference.mode}_id", mode_id)
+        df["predicted_label"] = probas.argmax(dim=1).numpy()
+        df[proba_columns] = probas.numpy()
+        return df
+
+    model_dfs, metrics = [], []
+    for (maps_name, split, selection_metric), model in models.items():
+        name = (maps_name, split, selection_metric)
+        maps_manager = model.maps_manager
+        probas = torch.cat(location_probas[name])
+        image_df = to_dataframe(torch.cat(image_probas[name]))
+        model_metrics = maps_manager.task_manager.compute_metrics(image_df, report_ci=False) if use_labels else None
+        if maps_manager.mode != "image":
+            ids = location_ids(model.preprocessing_dict, probas.shape[1])
+            mode_df = pd.concat([to_dataframe(probas[:, i], location_id) for i, location_id in enumerate(ids)])
+            mode_df = mode_df.sort_values(["participant_id", "session_id", f"{maps_manager.mode}_id"])
+            write_predictions(maps_manager, data_group, split, selection_metric, maps_manager.mode, mode_df)
+        write_predictions(maps_manager, data_group, split, selection_metric, "image", image_df, model_metrics)
+
+        description = {"maps": maps_name, "split": split, "selection_metric": selection_metric}
+        model_dfs.append(image_df.drop(columns=f"{reference.mode}_id").assign(**description))
+        if use_labels:
+            metrics.append({**description, **model_metrics})
+
+    ensemble_df = to_dataframe(torch.stack([torch.cat(image_probas[name]) for name in models]).mean(dim=0))
+    ensemble_df = ensemble_df.drop(columns=f"{reference.mode}_id")
+    models_df = pd.concat(model_dfs, ignore_index=True)
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    models_df.to_csv(output_dir / f"{data_group}_models_image_level_prediction.tsv", sep="\t", index=False)
+    ensemble_df.to_csv(output_dir / f"{data_group}_ensemble_image_level_prediction.tsv", sep="\t", index=False)
+    if use_labels:
+        ensemble_metrics = reference.task_manager.compute_metrics(ensemble_df, report_ci=False)
+        metrics.append({"maps": "ensemble", **ensemble_metrics})
+        pd.DataFrame(metrics).to_csv(
+            output_dir / f"{data_group}_ensemble_image_level_metrics.tsv", sep="\t", index=False
+        )
+    return models_df, ensemble_df
+
+
+# %% [markdown]
+# The next cell evaluates together all the splits of the two 2D slice-level
+# MAPS of the [classification notebook](./training_classification.ipynb): the
+# images of the test set are read once instead of once per MAPS and per split.
+
+# %%
+models_df, ensemble_df = predict_ensemble(
+    [
+        "data_oasis/maps_classification_2D_slice_resnet18",
+        "data_oasis/maps_classification_2D_slice_multi",
+    ],
+    "test-Oasis-ensemble",
+    "data_oasis/CAPS_example",
+    "data_oasis/split/test_baseline.tsv",
+    "data_oasis/ensemble",
+    gpu=gpu,
+)
+pd.read_csv("data_oasis/ensemble/test-Oasis-ensemble_ensemble_image_level_metrics.tsv", sep="\t")
+
+# %% [markdown]
+# ## Evaluate all the splits at once
+#
+# After a cross-validation, `clinicadl predict` evaluates the splits one after
+# the other, and reads the data group again for each split. The networks of
+# the different splits have the same architecture: they can be kept in memory
+# together and evaluated on the same batch.
+#
+# With `torch.func`, the weights of these networks are stacked, and the
+# forward pass is vectorized over the splits with `vmap`: all the splits are
+# evaluated in a single call, in which PyTorch computes the convolutions of all
+# the splits together.
+
+# %%
+import copy
+
+from torch.func import functional_call, stack_module_state, vmap
+
+
+class SplitEnsemble(nn.Module):
+    """Evaluates networks with the same architecture (one per split) in a single vectorized call."""
+    def __init__(self, networks):
+        super().__init__()
+        self.device = networks[0].device
+        self.params, self.buffers = stack_module_state(networks)
+        # The base network only provides the architecture, its weights are not used
+        self.base = copy.deepcopy(networks[0]).to("meta")
+
+    def _forward_one(self, params, buffers, x):
+        return functional_call(self.base, (params, buffers), (x,))
+
+    def forward(self, x):
+        """
+        :param x: (Tensor) batch of size (batch_size, C, ...).
+        :return: (Tensor) outputs of each network, of size (n_networks, batch_size, ...).
+        """
+        return vmap(self._forward_one, in_dims=(0, 0, None))(self.params, self.buffers, x)
+
+
+# %% [markdown]
+# The following function evaluates all the splits of a classification MAPS on
+# a data group, reading each image once. It writes the predictions of each
+# split in the MAPS, as `clinicadl predict` does, and the average of the
+# image-level probabilities of all the splits in
+# `ensemble/best-<metric>/<data_group>`.
+
+# %%
+def predict_split_ensemble(
+    maps_manager,
+    data_group,
+    caps_directory,
+    participants_tsv,
+    selection_metric="loss",
+    splits=None,
+    batch_size=8,
+    n_proc=2,
+    gpu=False,
+    use_labels=True,
+):
+    """
+    Predicts the outputs of all the splits of a classification MAPS in one pass.
+    :param splits: (list[int]) splits evaluated, by default all the splits of the MAPS.
+    :return: (DataFrame) the image-level predictions of the ensemble of the splits.
+    """
+    mode = maps_manager.mode
+    splits = splits or find_splits(maps_manager.maps_path)
+    group_df = load_data_test(Path(participants_tsv), maps_manager.diagnoses)
+    dataset = get_locations_dataset(maps_manager, caps_directory, group_df, use_labels=use_labels)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=n_proc, pin_memory=gpu)
+
+    # One ensemble of splits per network of the MAPS
+    network_indices = range(maps_manager.num_networks) if maps_manager.multi_network else [None]
+    ensembles = [
+        SplitEnsemble([
+            load_network(maps_manager, split, selection_metric, network=network, gpu=gpu)
+            for split in splits
+        ])
+        for network in network_indices
+    ]
+    if mode == "image":
+        weights = torch.ones(len(splits), 1)
+    else:
+        weights = torch.stack([soft_voting_weights(maps_manager, split, selection_metric) for split in splits])
+
+    all_probas, participant_ids, session_ids, labels = [], [], [], []
+    with torch.no_grad():
+        for data in loader:
+            images = data["image"]
+            n_images, n_locations = images.shape[:2]
+            # probas has size (n_splits, batch_size, n_locations, n_classes)
+            if len(ensembles) == 1:
+                ensemble = ensembles[0]
+                outputs = ensemble(images.flatten(0, 1).to(ensemble.device)).float()
+                probas = softmax(outputs, dim=-1).cpu().view(len(splits), n_images, n_locations, -1)
+            else:
+                probas = torch.stack(
+                    [
+                        softmax(ensemble(images[:, i].to(ensemble.device)).float(), dim=-1).cpu()
+                        for i, ensemble in enumerate(ensembles)
+                    ],
+                    dim=2,
+                )
+            all_probas.append(probas)
+            participant_ids += data["participant_id"]
+            session_ids += data["session_id"]
+            labels += data["label"].tolist() if use_labels else [-1] * n_images
+
+    probas = torch.cat(all_probas, dim=1)
+    image_probas = torch.einsum("sblc,sl->sbc", probas, weights)
+    ids = location_ids(maps_manager.preprocessing_dict, probas.shape[2])
+    task_manager = maps_manager.task_manager
+
+    def to_dataframe(probas, mode_id=0):
+        return pd.DataFrame(
+            [
+                [participant_id, session_id, mode_id, label, proba.argmax().item()] + proba.tolist()
+                for participant_id, session_id, label, proba in zip(participant_ids, session_ids, labels, probas)
+            ],
+            columns=task_manager.columns,
+        )
+
+    for split_idx, split in enumerate(splits):
+        if mode != "image":
+            mode_df = pd.concat([to_dataframe(probas[split_idx, :, i], location_id) for i, location_id in enumerate(ids)])
+            mode_df = mode_df.sort_values(["participant_id", "session_id", f"{mode}_id"])
+            mode_metrics = task_manager.compute_metrics(mode_df, report_ci=False) if use_labels else None
+            write_predictions(maps_manager, data_group, split, selection_metric, mode, mode_df, mode_metrics)
+        image_df = to_dataframe(image_probas[split_idx])
+        metrics = task_manager.compute_metrics(image_df, report_ci=False) if use_labels else None
+        write_predictions(maps_manager, data_group, split, selection_metric, "image", image_df, metrics)
+
+    ensemble_df = to_dataframe(image_probas.mean(dim=0))
+    ensemble_dir = maps_manager.maps_path / "ensemble" / f"best-{selection_metric}" / data_group
+    ensemble_dir.mkdir(parents=True, exist_ok=True)
+    ensemble_df.to_csv(ensemble_dir / f"{data_group}_image_level_prediction.tsv", sep="\t", index=False)
+    if use_labels:
+        pd.DataFrame(task_manager.compute_metrics(ensemble_df, report_ci=False), index=[0]).to_csv(
+            ensemble_dir / f"{data_group}_image_level_metrics.tsv", sep="\t", index=False
+        )
+    return ensemble_df
+
+
+# %% [markdown]
+# The next cell compares the time needed to evaluate the 4 splits of the
+# 2D slice-level CNN one after the other and all at once.
+
+# %%
+maps_manager = MapsManager(Path("data_oasis/maps_classification_2D_slice_resnet18"))
+start = perf_counter()
+for split in find_splits(maps_manager.maps_path):
+    predict_network(
+        maps_manager,
+        "test-Oasis-splits",
+        "data_oasis/CAPS_example",
+        "data_oasis/split/test_baseline.tsv",
+        split=split,
+        gpu=gpu,
+    )
+print(f"Splits evaluated one after the other in {perf_counter() - start:.1f} s")
+
+start = perf_counter()
+ensemble_df = predict_split_ensemble(
+    maps_manager,
+    "test-Oasis-splits",
+    "data_oasis/CAPS_example",
+    "data_oasis/split/test_baseline.tsv",
+    gpu=gpu,
+)
+print(f"Splits evaluated at once in {perf_counter() - start:.1f} s")
+ensemble_df.head()
+
+# %% [markdown]
+# ## Stream the predictions of large data groups
+#
+# `clinicadl predict` keeps all the predictions in memory and writes the TSV
+# files at the end of the evaluation. For a data group of tens of thousands of
+# sessions, an interruption loses all the predictions already computed.
+#
+# The following writer appends the predictions to the TSV files by chunks.
+# After each chunk, it saves a checkpoint with the size of the files and the
+# state needed to compute the metrics. When the prediction is run again, the
+# files are truncated to the size saved in the checkpoint (to remove a chunk
+# which may have been partially written), and only the sessions which are not
+# in the files are predicted.
+#
+# The metrics of a classification only depend on the confusion matrix: it is
+# the only state saved, and the metrics are computed from it by the
+# `MetricModule` of ClinicaDL each time a chunk is written.
+
+# %%
+import os
+
+import numpy as np
+
+
+def confusion_matrix_metrics(task_manager, confusion_matrix):
+    """
+    Computes the metrics of a classification from its confusion matrix.
+    :param confusion_matrix: (array) number of sessions of true label i predicted as j.
+    :return: (dict) the metrics computed by the MetricModule of the task manager.
+    """
+    confusion_matrix = np.asarray(confusion_matrix)
+    true_labels, predicted_labels = np.indices(confusion_matrix.shape)
+    return task_manager.metrics_module.apply(
+        np.repeat(true_labels.ravel(), confusion_matrix.ravel()),
+        np.repeat(predicted_labels.ravel(), confusion_matrix.ravel()),
+        report_ci=False,
+    )
+
+
+class StreamingPredictionWriter:
+    """
+    Appends the predictions of several levels to TSV files by chunks, and saves
+    a checkpoint after each chunk to resume an interrupted prediction.
+    """
+    def __init__(self, paths, columns, checkpoint_path):
+        """
+        :param paths: (dict[str, Path]) TSV file of each level.
+        :param columns: (list[str]) columns of the TSV files.
+        :param checkpoint_path: (Path) JSON file in which the progress is saved.
+        """
+        self.paths = paths
+        self.columns = columns
+        self.checkpoint_path = checkpoint_path
+        self.pending = {level: [] for level in paths}
+
+    def resume(self):
+        """
+        Restores the files as they were at the last checkpoint.
+        :return: (set, dict) the (participant_id, session_id) already written, and the state of the checkpoint.
+        """
+        if not self.checkpoint_path.is_file():
+            for path in self.paths.values():
+                path.unlink(missing_ok=True)
+            return set(), None
+        with self.checkpoint_path.open() as f:
+            checkpoint = json.load(f)
+        for level, path in self.paths.items():
+            os.truncate(path, checkpoint["sizes"][level])
+        key_path = self.paths["image"]
+        keys_df = pd.read_csv(key_path, sep="\t", usecols=["participant_id", "session_id"])
+        return set(zip(keys_df.participant_id, keys_df.session_id)), checkpoint["state"]
+
+    def add(self, level, rows):
+        self.pending[level] += rows
+
+    def __len__(self):
+        return len(self.pending["image"])
+
+    def flush(self, state):
+        """Writes the pending rows, then the checkpoint with the given state."""
+        for level, path in self.paths.items():
+            with path.open("a") as f:
+                pd.DataFrame(self.pending[level], columns=self.columns).to_csv(
+                    f, sep="\t", index=False, header=(f.tell() == 0)
+                )
+                f.flush()
+                os.fsync(f.fileno())
+            self.pending[level] = []
+        checkpoint = {
+            "sizes": {level: path.stat().st_size for level, path in self.paths.items()},
+            "state": state,
+        }
+        tmp_path = self.checkpoint_path.with_suffix(".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+
+# %% [markdown]
+# The prediction relies on the `ResidentModel` of the previous sections, so it
+# can use a MAPS of any mode, with one or several networks. The files have the
+# names used by `clinicadl predict`, and the checkpoint is written next to them
+# in `<data_group>_checkpoint.json`.
+
+# %%
+def prediction_rows(model, images, sessions):
+    """
+    Predicts a batch of images with a ResidentModel, as rows of the prediction TSV files.
+    :param images: (list[Tensor]) image tensors read by read_images.
+    :param sessions: (list[tuple]) participant_id, session_id and label (-1 if unknown) of each image.
+    :return: (dict[str, list]) the rows of each level: the image and the mode of the MAPS.
+    """
+    mode = model.maps_manager.mode
+    probas, image_probas = model.predict_images(images)
+    ids = location_ids(model.preprocessing_dict, probas.shape[1])
+    rows = {"image": []} if mode == "image" else {mode: [], "image": []}
+    for (participant_id, session_id, label), location_probas, image_proba in zip(sessions, probas, image_probas):
+        rows["image"].append([participant_id, session_id, 0, label, image_proba.argmax().item()] + image_proba.tolist())
+        if mode != "image":
+            rows[mode] += [
+                [participant_id, session_id, location_id, label, proba.argmax().item()] + proba.tolist()
+                for location_id, proba in zip(ids, location_probas)
+            ]
+    return rows
+
+
+def predict_streaming(
+    maps_path,
+    data_group,
+    caps_directory,
+    participants_tsv,
+    split=0,
+    selection_metric="loss",
+    batch_size=8,
+    chunk_size=256,
+    n_proc=2,
+    gpu=False,
+    use_labels=True,
+    scripted=False,
+):
+    """
+    Predicts the sessions of a data group with a classification MAPS, writing the predictions by chunks.
+    :param chunk_size: (int) number of sessions written at once.
+    :return: (dict) the image-level metrics, or None if use_labels is False.
+    """
+    model = ResidentModel(maps_path, caps_directory, split, selection_metric, gpu=gpu, scripted=scripted)
+    maps_manager = model.maps_manager
+    mode = maps_manager.mode
+    task_manager = maps_manager.task_manager
+    performance_dir = maps_manager.maps_path / f"split-{split}" / f"best-{selection_metric}" / data_group
+    performance_dir.mkdir(parents=True, exist_ok=True)
+
+    levels = ["image"] if mode == "image" else [mode, "image"]
+    writer = StreamingPredictionWriter(
+        {level: performance_dir / f"{data_group}_{level}_level_prediction.tsv" for level in levels},
+        task_manager.columns,
+        performance_dir / f"{data_group}_checkpoint.json",
+    )
+    processed, state = writer.resume()
+    n_classes = len(maps_manager.label_code)
+    confusion_matrix = np.array(state["confusion_matrix"]) if state else np.zeros((n_classes, n_classes), dtype=int)
+
+    group_df = load_data_test(Path(participants_tsv), maps_manager.diagnoses)
+    is_processed = [key in processed for key in zip(group_df.participant_id, group_df.session_id)]
+    group_df = group_df[~np.array(is_processed, dtype=bool)].reset_index(drop=True)
+    if use_labels:
+        labels = group_df[maps_manager.label].map(maps_manager.label_code).tolist()
+    else:
+        labels = [-1] * len(group_df)
+    loader = []
+    if len(group_df) > 0:
+        image_dataset = CapsDatasetImage(
+            model.caps_directory, group_df, model.preprocessing_dict, label_presence=False
+        )
+        loader = DataLoader(
+            SessionImagesDataset([image_dataset]), batch_size=batch_size, num_workers=n_proc, collate_fn=collate_images
+        )
+
+    metrics_path = performance_dir / f"{data_group}_image_level_metrics.tsv"
+    for start, (images,) in zip(range(0, len(group_df), batch_size), loader):
+        batch_df = group_df.iloc[start : start + len(images)]
+        sessions = zip(batch_df.participant_id, batch_df.session_id, labels[start : start + len(images)])
+        for level, rows in prediction_rows(model, images, sessions).items():
+            writer.add(level, rows)
+            if level == "image" and use_labels:
+                for _, _, _, label, predicted_label, *_ in rows:
+                    confusion_matrix[label, predicted_label] += 1
+
+        if len(writer) >= chunk_size:
+            writer.flush({"confusion_matrix": confusion_matrix.tolist()})
+            if use_labels:
+                pd.DataFrame(confusion_matrix_metrics(task_manager, confusion_matrix), index=[0]).to_csv(
+                    metrics_path, sep="\t", index=False
+                )
+
+    writer.flush({"confusion_matrix": confusion_matrix.tolist()})
+    if not use_labels:
+        return None
+    metrics = confusion_matrix_metrics(task_manager, confusion_matrix)
+    pd.DataFrame(metrics, index=[0]).to_csv(metrics_path, sep="\t", index=False)
+    return metrics
+
+
+# %% [markdown]
+# If the next cell is interrupted, running it again only predicts the sessions
+# which were not written yet. Once all the sessions are predicted, running it
+# again only computes the metrics from the checkpoint. To predict the data
+# group again from scratch, delete the checkpoint.
+
+# %%
+predict_streaming(
+    "data_oasis/maps_classification_2D_slice_multi",
+    "test-Oasis-streaming",
+    "data_oasis/CAPS_example",
+    "data_oasis/split/test_baseline.tsv",
+    chunk_size=16,
+    gpu=gpu,
+)
+
+# %% [markdown]
+# ## Aggregate the stored outputs again
+#
+# For slice and patch modes, the image-level prediction is the soft-voting of
+# the predictions of the locations. Trying another voting rule, or another
+# `selection_threshold`, usually means running `clinicadl predict` again,
+# even though the outputs of the networks do not change.
+#
+# The following function predicts a data group once and stores the outputs of
+# the networks before the softmax (the logits) of every location in a
+# compressed NumPy archive, next to the other outputs of the data group:
+# `<data_group>_<mode>_level_outputs.npz`. The archive also contains the
+# participant, session, label and location ids, so it is enough to rebuild the
+# image-level predictions.
+
+# %%
+def store_location_outputs(
+    maps_path,
+    data_group,
+    caps_directory,
+    participants_tsv,
+    split=0,
+    selection_metric="loss",
+    batch_size=8,
+    n_proc=2,
+    gpu=False,
+    use_labels=True,
+    scripted=False,
+):
+    """
+    Predicts a data group and stores the logits of each location in the MAPS.
+    :return: (Path) the archive in which the logits are stored.
+    """
+    model = ResidentModel(maps_path, caps_directory, split, selection_metric, gpu=gpu, scripted=scripted)
+    maps_manager = model.maps_manager
+    group_df = load_data_test(Path(participants_tsv), maps_manager.diagnoses)
+    if use_labels:
+        labels = group_df[maps_manager.label].map(maps_manager.label_code).values
+    else:
+        labels = np.full(len(group_df), -1)
+    image_dataset = CapsDatasetImage(
+        model.caps_directory, group_df, model.preprocessing_dict, label_presence=False
+    )
+    loader = DataLoader(
+        SessionImagesDataset([image_dataset]), batch_size=batch_size, num_workers=n_proc, collate_fn=collate_images
+    )
+    logits = torch.cat([model.compute_logits(images) for (images,) in loader])
+
+    performance_dir = maps_manager.maps_path / f"split-{split}" / f"best-{selection_metric}" / data_group
+    performance_dir.mkdir(parents=True, exist_ok=True)
+    outputs_path = performance_dir / f"{data_group}_{maps_manager.mode}_level_outputs.npz"
+    np.savez_compressed(
+        outputs_path,
+        logits=logits.numpy(),
+        participant_id=group_df.participant_id.to_numpy(dtype=str),
+        session_id=group_df.session_id.to_numpy(dtype=str),
+        true_label=labels.astype(int),
+        location_id=np.array(location_ids(model.preprocessing_dict, logits.shape[1])),
+    )
+    return outputs_path
+
+
+# %% [markdown]
+# The image-level probabilities are then computed from the logits with one of
+# the following rules:
+# - `soft_voting`: the rule of `clinicadl predict`, the probabilities of the
+# locations are weighted by their accuracy on the validation set (locations
+# with an accuracy lower than `selection_threshold` are discarded),
+# - `mean`: the probabilities of the locations are averaged,
+# - `logit_mean`: the logits of the locations are averaged before the softmax,
+# - `majority`: each location votes for its predicted class, and the
+# probability of a class is its fraction of the votes (ties are broken by
+# the mean probability).
+
+# %%
+from scipy.special import softmax as np_softmax
+
+AGGREGATION_RULES = ["soft_voting", "mean", "logit_mean", "majority"]
+
+
+def aggregate_locations(logits, rule="soft_voting", accuracies=None, selection_threshold=None):
+    """
+    Computes the image-level predictions from the logits of the locations.
+    :param logits: (array) logits of size (n_images, n_locations, n_classes).
+    :param rule: (str) one of AGGREGATION_RULES.
+    :param accuracies: (array) validation accuracy of each location, needed by soft_voting.
+    :param selection_threshold: (float) locations with a lower accuracy are discarded by soft_voting.
+    :return: (array, array) the probabilities of size (n_images, n_classes) and the predicted labels.
+    """
+    probas = np_softmax(logits, axis=2)
+    if rule == "soft_voting":
+        weights = np.asarray(accuracies, dtype=float).copy()
+        if selection_threshold is not None:
+            weights[weights < selection_threshold] = 0
+        image_probas = np.einsum("bnc,n->bc", probas, weights / weights.sum())
+    elif rule == "mean":
+        image_probas = probas.mean(axis=1)
+    elif rule == "logit_mean":
+        image_probas = np_softmax(logits.mean(axis=1), axis=1)
+    elif rule == "majority":
+        image_probas = np.eye(logits.shape[2])[logits.argmax(axis=2)].mean(axis=1)
+        # The mean probability is lower than one vote, so it only decides between tied classes
+        n_locations = logits.shape[1]
+        return image_probas, (image_probas * n_locations + probas.mean(axis=1)).argmax(axis=1)
+    else:
+        raise ValueError(f"Unknown aggregation rule {rule}. Available rules are {AGGREGATION_RULES}.")
+    return image_probas, image_probas.argmax(axis=1)
+
+
+def aggregate_stored_outputs(maps_manager, data_group, split=0, selection_metric="loss", rule="soft_voting", selection_threshold=None):
+    """
+    Computes the image-level predictions and metrics of a data group from the stored logits.
+    :param selection_threshold: (float) threshold of soft_voting, by default the one of the MAPS.
+    :return: (DataFrame, dict) the image-level predictions, and their metrics if the labels are known.
+    """
+    performance_dir = maps_manager.maps_path / f"split-{split}" / f"best-{selection_metric}" / data_group
+    with np.load(performance_dir / f"{data_group}_{maps_manager.mode}_level_outputs.npz") as archive:
+        outputs = dict(archive)
+    accuracies = None
+    if rule == "soft_voting":
+        accuracies = validation_accuracies(maps_manager, split, selection_metric).loc[outputs["location_id"]].values
+        if selection_threshold is None:
+            selection_threshold = maps_manager.selection_threshold
+
+    image_probas, predicted_labels = aggregate_locations(outputs["logits"], rule, accuracies, selection_threshold)
+    columns = maps_manager.task_manager.columns
+    image_df = pd.DataFrame({
+        columns[0]: outputs["participant_id"],
+        columns[1]: outputs["session_id"],
+        columns[2]: 0,
+        columns[3]: outputs["true_label"],
+        columns[4]: predicted_labels,
+        **dict(zip(columns[5:], image_probas.T)),
+    })
+    metrics = None
+    if (outputs["true_label"] >= 0).all():
+        metrics = maps_manager.task_manager.compute_metrics(image_df, report_ci=False)
+    return image_df, metrics
+
+
+# %% [markdown]
+# The next cell stores the logits of the 2D slice-level multi-CNN on the test
+# set, then compares the rules and several thresholds of the soft-voting. Each
+# aggregation only reads the archive, so it takes a few milliseconds instead of
+# a full prediction.
+
+# %%
+maps_manager = MapsManager(Path("data_oasis/maps_classification_2D_slice_multi"))
+store_location_outputs(
+    "data_oasis/maps_classification_2D_slice_multi",
+    "test-Oasis-outputs",
+    "data_oasis/CAPS_example",
+    "data_oasis/split/test_baseline.tsv",
+    gpu=gpu,
+)
+
+comparison = []
+for rule, selection_threshold in [(rule, None) for rule in AGGREGATION_RULES] + [("soft_voting", 0.6), ("soft_voting", 0.7)]:
+    start = perf_counter()
+    _, metrics = aggregate_stored_outputs(
+        maps_manager, "test-Oasis-outputs", rule=rule, selection_threshold=selection_threshold
+    )
+    comparison.append({
+        "rule": rule,
+        "selection_threshold": selection_threshold,
+        "time_ms": 1000 * (perf_counter() - start),
+        "balanced_accuracy": metrics["BA"],
+    })
+pd.DataFrame(comparison)
+
+# %% [markdown]
+# To keep one of these predictions, write it with `write_predictions` under a
+# new data group name, so that the outputs of `clinicadl predict` are not
+# replaced.
+
+# %% [markdown]
+# ## Predict the new sessions of a data group
+#
+# A data group of `clinicadl predict` is fixed once it is created: running it
+# again with a longer `participants_tsv` fails, unless `--overwrite` is given,
+# in which case all the sessions are predicted again. When new sessions are
+# added every day to a cohort, only these sessions need to be predicted.
+#
+# The following function compares the participants TSV with the image-level
+# predictions already written in the data group, predicts the missing sessions
+# with a `ResidentModel`, and merges them with the previous predictions. The
+# metrics are then computed again on all the sessions, and the list of
+# sessions of the data group (`groups/<data_group>/data.tsv`) is updated, so
+# that the data group can still be used by the other commands of ClinicaDL.
+
+# %%
+def predict_incremental(
+    maps_path,
+    data_group,
+    caps_directory,
+    participants_tsv,
+    split=0,
+    selection_metric="loss",
+    batch_size=8,
+    n_proc=2,
+    gpu=False,
+    use_labels=True,
+    scripted=False,
+):
+    """
+    Predicts the sessions of participants_tsv which are not yet in the data group, and merges the predictions.
+    :return: (DataFrame, dict) the image-level predictions of all the sessions, and their metrics if use_labels.
+    """
+    model = ResidentModel(maps_path, caps_directory, split, selection_metric, gpu=gpu, scripted=scripted)
+    maps_manager = model.maps_manager
+    mode = maps_manager.mode
+    task_manager = maps_manager.task_manager
+    levels = ["image"] if mode == "image" else [mode, "image"]
+    performance_dir = maps_manager.maps_path / f"split-{split}" / f"best-{selection_metric}" / data_group
+
+    previous_dfs = {level: pd.DataFrame(columns=task_manager.columns) for level in levels}
+    if (performance_dir / f"{data_group}_image_level_prediction.tsv").is_file():
+        previous_dfs = {
+            level: pd.read_csv(performance_dir / f"{data_group}_{level}_level_prediction.tsv", sep="\t")
+            for level in levels
+        }
+    previous_keys = set(zip(previous_dfs["image"].participant_id, previous_dfs["image"].session_id))
+    group_df = load_data_test(Path(participants_tsv), maps_manager.diagnoses)
+    is_new = [key not in previous_keys for key in zip(group_df.participant_id, group_df.session_id)]
+    new_df = group_df[np.array(is_new, dtype=bool)].reset_index(drop=True)
+    print(f"{len(new_df)} new sessions to predict in {data_group}.")
+
+    rows = {level: [] for level in levels}
+    if len(new_df) > 0:
+        labels = new_df[maps_manager.label].map(maps_manager.label_code).tolist() if use_labels else [-1] * len(new_df)
+        image_dataset = CapsDatasetImage(
+            model.caps_directory, new_df, model.preprocessing_dict, label_presence=False
+        )
+        loader = DataLoader(
+            SessionImagesDataset([image_dataset]), batch_size=batch_size, num_workers=n_proc, collate_fn=collate_images
+        )
+        for start, (images,) in zip(range(0, len(new_df), batch_size), loader):
+            batch_df = new_df.iloc[start : start + len(images)]
+            sessions = zip(batch_df.participant_id, batch_df.session_id, labels[start : start + len(images)])
+            for level, batch_rows in prediction_rows(model, images, sessions).items():
+                rows[level] += batch_rows
+
+    for level in levels:
+        prediction_df = pd.concat(
+            [previous_dfs[level], pd.DataFrame(rows[level], columns=task_manager.columns)], ignore_index=True
+        )
+        metrics = task_manager.compute_metrics(prediction_df, report_ci=False) if use_labels else None
+        write_predictions(maps_manager, data_group, split, selection_metric, level, prediction_df, metrics)
+
+    group_path = maps_manager.maps_path / "groups" / data_group
+    columns = ["participant_id", "session_id", "cohort"] + ([maps_manager.label] if use_labels else [])
+    if (group_path / "data.tsv").is_file():
+        previous_group_df = pd.read_csv(group_path / "data.tsv", sep="\t")
+        new_df = pd.concat([previous_group_df, new_df[columns]], ignore_index=True)
+    else:
+        maps_manager.write_parameters(group_path, {"caps_directory": caps_directory, "multi_cohort": False}, verbose=False)
+    new_df.drop_duplicates(["participant_id", "session_id"]).to_csv(
+        group_path / "data.tsv", sep="\t", columns=columns, index=False
+    )
+    return prediction_df, metrics
+
+
+# %% [markdown]
+# In the next cell, the data group is first created with half of the test
+# sessions, then completed with all the sessions: only the second half is
+# predicted by the second call.
+
+# %%
+test_df = pd.read_csv("data_oasis/split/test_baseline.tsv", sep="\t")
+test_df.iloc[: len(test_df) // 2].to_csv("data_oasis/split/test_baseline_first_half.tsv", sep="\t", index=False)
+
+for participants_tsv in ["data_oasis/split/test_baseline_first_half.tsv", "data_oasis/split/test_baseline.tsv"]:
+    image_df, metrics = predict_incremental(
+        "data_oasis/maps_classification_2D_slice_multi",
+        "test-Oasis-incremental",
+        "data_oasis/CAPS_example",
+        participants_tsv,
+        gpu=gpu,
+    )
+metrics
+
+# %% [markdown]
+# ```{note}
+# As for the other recipes of this notebook, the participants of the new
+# sessions are not compared with the participants of the training set: check
+# that they were not used to train the MAPS before predicting them.
+# ```
+
+# %% [markdown]
+# ## Quantize the networks for CPU
+#
+# On a machine without GPU, the prediction can be accelerated by computing the
+# convolutions and the fully-connected layers with 8-bit integers (`int8`)
+# instead of `float32`. PyTorch provides two post-training quantizations:
+# - the `dynamic` quantization converts the weights of the fully-connected
+# layers to `int8` and quantizes their inputs on the fly. It needs no data, but
+# the convolutions are not quantized, so it mostly reduces the size of the
+# networks whose fully-connected layers are large, like `Conv5_FC3`.
+# - the `static` quantization also quantizes the convolutions (fused with
+# their batch normalization and ReLU), and the activations between them. The
+# range of each activation is calibrated by running the network on a few
+# images of the training set of the split.
+#
+# The quantized networks are exported with TorchScript, as in the previous
+# section, in `split-<i>/best-<metric>/model_int8.pt` (or
+# `network-<j>_model_int8.pt`), and are then used with `quantized=True` in
+# `predict_network` and `predict_multi_network`. The pooling layers of
+# ClinicaDL compute their padding from the size of their input: they are kept
+# in `float32`.
+
+# %%
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from clinicadl.utils.network.network_utils import PadMaxPool2d, PadMaxPool3d
+
+
+def prepare_static_quantization(model, example):
+    """
+    Inserts the observers calibrating the static int8 quantization of a ClinicaDL network.
+    Run the prepared network on calibration batches, then quantize it with convert_fx.
+    :param model: (Network) the network, on CPU.
+    :param example: (Tensor) an input batch of the network.
+    :return: (GraphModule) the prepared network, whose forward method is the predict method of model.
+    """
+    return prepare_fx(
+        Predictor(model).eval(),
+        get_default_qconfig_mapping(torch.backends.quantized.engine),
+        (example,),
+        prepare_custom_config=PrepareCustomConfig().set_non_traceable_module_classes([PadMaxPool2d, PadMaxPool3d]),
+    )
+
+
+def quantize_network(model, calibration_batches=None, mode="static"):
+    """
+    Quantizes the convolutions and fully-connected layers of a ClinicaDL network in int8.
+    :param model: (Network) the network, on CPU.
+    :param calibration_batches: (iterable[Tensor]) inputs used to calibrate the static quantization, read one by one.
+    :param mode: (str) static or dynamic.
+    :return: (nn.Module) the quantized network, whose forward method is the predict method of model.
+    """
+    if mode == "dynamic":
+        return quantize_dynamic(Predictor(model).eval(), {nn.Linear}, dtype=torch.qint8)
+    if mode != "static":
+        raise ValueError(f"Unknown quantization mode {mode}. Available modes are static and dynamic.")
+    prepared = None
+    with torch.no_grad():
+        for batch in calibration_batches:
+            if prepared is None:
+                prepared = prepare_static_quantization(model, batch)
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+def export_quantized(
+    maps_manager, caps_directory, split=0, selection_metrics=None, mode="static", n_calibration=32, batch_size=8
+):
+    """
+    Quantizes the networks of a split and exports them with TorchScript.
+    :param caps_directory: (Path) CAPS in which the training data group of the MAPS is read for the calibration.
+    :param n_calibration: (int) number of sessions of the training set used for the calibration.
+    :param batch_size: (int) maximal number of locations in a calibration batch.
+    :return: (list[Path]) paths of the exported files.
+    """
+    if selection_metrics is None:
+        selection_metrics = maps_manager.selection_metrics
+    networks = range(maps_manager.num_networks) if maps_manager.multi_network else [None]
+    example = torch.zeros([1] + maps_manager.input_size)
+    models = {
+        (selection_metric, network): load_network(maps_manager, split, selection_metric, network=network)
+        for selection_metric in selection_metrics
+        for network in networks
+    }
+
+    if mode == "static":
+        # The calibration sessions are read one by one, and their locations of size
+        # (n_locations, C, [D,] H, W) are given by batches to all the networks at once.
+        # Each network of a multi-network is calibrated on its own location.
+        train_df, _ = maps_manager.get_group_info("train", split)
+        train_df = train_df.sample(min(n_calibration, len(train_df)), random_state=0).reset_index(drop=True)
+        dataset = get_locations_dataset(maps_manager, caps_directory, train_df, use_labels=False)
+        prepared = dict()
+        with torch.no_grad():
+            for data in DataLoader(dataset, batch_size=1):
+                locations = data["image"][0]
+                for key, model in models.items():
+                    network = key[1]
+                    batches = locations.split(batch_size) if network is None else [locations[network : network + 1]]
+                    for batch in batches:
+                        if key not in prepared:
+                            prepared[key] = prepare_static_quantization(model, batch)
+                        prepared[key](batch)
+        quantized_models = {key: convert_fx(module) for key, module in prepared.items()}
+    else:
+        quantized_models = {key: quantize_network(model, mode=mode) for key, model in models.items()}
+
+    paths = []
+    for (selection_metric, network), quantized in quantized_models.items():
+        with torch.no_grad(), warnings.catch_warnings():
+            warnings.simplefilter("ignore", torch.jit.TracerWarning)
+            traced = torch.jit.trace(quantized, example)
+        path = scripted_model_path(maps_manager, split, selection_metric, network, quantized=True)
+        torch.jit.save(
+            torch.jit.freeze(traced),
+            path,
+            _extra_files={"maps.json": json.dumps({
+                "architecture": maps_manager.architecture,
+                "input_size": maps_manager.input_size,
+                "network": network,
+                "quantization": mode,
+            })},
+        )
+        paths.append(path)
+    return paths
+
+
+# %% [markdown]
+# The quantization changes the outputs of the networks. The following function
+# predicts the validation set of the split with the `float32` networks and with
+# the `int8` networks, in the data groups `validation-float32` and
+# `validation-int8`, and reports the size of the files of the networks in the
+# MAPS, the time of the
+# prediction and the image-level metrics, with the difference between the two.
+
+# %%
+def quantization_report(maps_manager, caps_directory, split=0, selection_metric="loss", batch_size=8, n_proc=2):
+    """
+    Compares the float32 and int8 networks of a split on its validation set.
+    :return: (DataFrame) size, prediction time and image-level metrics of each precision, and their difference.
+    """
+    validation_tsv = maps_manager.maps_path / "groups" / "validation" / f"split-{split}" / "data.tsv"
+    predict = predict_multi_network if maps_manager.multi_network else predict_network
+    networks = range(maps_manager.num_networks) if maps_manager.multi_network else [None]
+    best_dir = maps_manager.maps_path / f"split-{split}" / f"best-{selection_metric}"
+
+    report = []
+    for quantized in [False, True]:
+        precision = "int8" if quantized else "float32"
+        data_group = f"validation-{precision}"
+        start = perf_counter()
+        predict(
+            maps_manager,
+            data_group,
+            caps_directory,
+            validation_tsv,
+            split=split,
+            selection_metric=selection_metric,
+            batch_size=batch_size,
+            n_proc=n_proc,
+            quantized=quantized,
+        )
+        predict_time = perf_counter() - start
+        file_name = "model_int8.pt" if quantized else "model.pth.tar"
+        size = sum(
+            (best_dir / (file_name if network is None else f"network-{network}_{file_name}")).stat().st_size
+            for network in networks
+        )
+        metrics_df = pd.read_csv(best_dir / data_group / f"{data_group}_image_level_metrics.tsv", sep="\t")
+        report.append({"precision": precision, "size_MiB": size / 2 ** 20, "predict_time": predict_time, **metrics_df.iloc[0]})
+
+    report_df = pd.DataFrame(report).set_index("precision")
+    report_df.loc["difference"] = report_df.loc["int8"] - report_df.loc["float32"]
+    return report_df
+
+
+# %% [markdown]
+# The next cell quantizes the 2D slice-level CNN of the
+# [classification notebook](./training_classification.ipynb) and compares it
+# with the `float32` network:
+
+# %%
+maps_manager = MapsManager(Path("data_oasis/maps_classification_2D_slice_resnet18"))
+export_quantized(maps_manager, "data_oasis/CAPS_example")
+quantization_report(maps_manager, "data_oasis/CAPS_example")
+
+# %% [markdown]
+# ```{note}
+# The `int8` operations are only available on CPU: the quantized networks are
+# always evaluated on CPU, even with `gpu=True`. The static quantization is
+# usually the fastest, but check the metrics of the report before using it: if
+# the difference is too large, increase `n_calibration` or use the `dynamic`
+# mode.
+#
+# Recent versions of PyTorch move these quantization tools to the `torchao`
+# library (`prepare_pt2e` and `convert_pt2e`). The same steps apply: prepare,
+# calibrate on the training set, convert and export.
+# ```
+
+# %% [markdown]
+# ## Predict the slices of a volume in one batch
+#
+# With a single-network MAPS trained on slices, `clinicadl predict` (and
+# `predict_network`) gives one slice per sample to the network: each slice is
+# read from its own file, or extracted from an image read once per slice, and
+# the batches mix the slices of several sessions. The soft-voting is only
+# computed at the end, from the slice-level TSV file.
+#
+# The following function reads each image once, in the workers of the
+# `DataLoader`, stacks all its slices (or patches) in a single batch given to
+# the network, and computes the image-level prediction of the session right
+# after. The batch is split in chunks of `max_batch_size` locations, so a
+# session is predicted in one or two forward passes.
+
+# %%
+def predict_by_volume(
+    maps_manager,
+    data_group,
+    caps_directory,
+    participants_tsv,
+    split=0,
+    selection_metric="loss",
+    max_batch_size=128,
+    n_proc=2,
+    gpu=False,
+    use_labels=True,
+    amp=False,
+    scripted=False,
+    quantized=False,
+):
+    """
+    Predicts the outputs of a single-network MAPS session by session, with all the locations of a session in one batch.
+    :param max_batch_size: (int) maximal number of locations given to the network at once.
+    :return: (DataFrame, DataFrame) the predictions at the location and at the image levels.
+    """
+    if maps_manager.multi_network:
+        raise ValueError("Each network of a multi-network MAPS predicts one location: use predict_multi_network.")
+    mode = maps_manager.mode
+    gpu = gpu and not quantized
+    group_df = load_data_test(Path(participants_tsv), maps_manager.diagnoses)
+    dataset = get_locations_dataset(maps_manager, caps_directory, group_df, use_labels=use_labels)
+    # Without automatic batching, each sample of the loader is a whole session
+    loader = DataLoader(dataset, batch_size=None, num_workers=n_proc, pin_memory=gpu)
+
+    if scripted or quantized:
+        predict = load_scripted_network(maps_manager, split, selection_metric, gpu=gpu, quantized=quantized)
+        device = "cuda" if gpu else "cpu"
+    else:
+        model = load_network(maps_manager, split, selection_metric, gpu=gpu)
+        predict, device = model.predict, model.device
+    if mode == "image":
+        weights = torch.ones(1)
+    else:
+        weights = soft_voting_weights(maps_manager, split, selection_metric)
+    ids = location_ids(maps_manager.preprocessing_dict, len(weights))
+
+    columns = maps_manager.task_manager.columns
+    mode_rows, image_rows = [], []
+    with torch.no_grad():
+        for data in loader:
+            locations = data["image"].to(device, non_blocking=True)
+            with autocast_context(device, amp):
+                outputs = torch.cat([predict(chunk).float() for chunk in locations.split(max_batch_size)])
+            probas = softmax(outputs, dim=1).cpu()
+            image_proba = weights @ probas
+            participant_id, session_id = data["participant_id"], data["session_id"]
+            label = data["label"] if use_labels else -1
+            mode_rows += [
+                [participant_id, session_id, location_id, label, proba.argmax().item()] + proba.tolist()
+                for location_id, proba in zip(ids, probas)
+            ]
+            image_rows.append([participant_id, session_id, 0, label, image_proba.argmax().item()] + image_proba.tolist())
+
+    mode_df = pd.DataFrame(mode_rows, columns=columns)
+    image_df = pd.DataFrame(image_rows, columns=columns)
+    task_manager = maps_manager.task_manager
+    if mode != "image":
+        mode_metrics = task_manager.compute_metrics(mode_df, report_ci=False) if use_labels else None
+        write_predictions(maps_manager, data_group, split, selection_metric, mode, mode_df, mode_metrics)
+    metrics = task_manager.compute_metrics(image_df, report_ci=False) if use_labels else None
+    write_predictions(maps_manager, data_group, split, selection_metric, "image", image_df, metrics)
+    return mode_df, image_df
+
+
+# %% [markdown]
+# The next cell compares the time needed to predict the test set with the
+# 2D slice-level CNN of the [classification notebook](./training_classification.ipynb),
+# slice by slice and volume by volume:
+
+# %%
+maps_manager = MapsManager(Path("data_oasis/maps_classification_2D_slice_resnet18"))
+timings = []
+for by_volume in [False, True]:
+    start = perf_counter()
+    if by_volume:
+        _, image_df = predict_by_volume(
+            maps_manager, "test-Oasis-volume", "data_oasis/CAPS_example", "data_oasis/split/test_baseline.tsv", gpu=gpu
+        )
+    else:
+        predict_network(
+            maps_manager, "test-Oasis-slices", "data_oasis/CAPS_example", "data_oasis/split/test_baseline.tsv", gpu=gpu
+        )
+    timings.append({"by_volume": by_volume, "predict_time": perf_counter() - start})
+pd.DataFrame(timings)
+
+# %% [markdown]
+# ```{note}
+# All the locations of a session are in memory at the same time: with 3D
+# patches, reduce `max_batch_size` if the memory of the GPU is too small.
+# ```
+
+# %% [markdown]
+# ## Sliding-window prediction of the patches
+#
+# With a single network trained on 3D patches, as the `AE_Conv4_FC3` of the
+# [reconstruction notebook](./training_reconstruction.ipynb), each patch is a
+# sample of the dataset: it is read from its own file, or extracted from an
+# image read once per patch. With `--save_nifti`, `clinicadl predict` writes
+# one file per sample, so the reconstruction of a whole image is not
+# available in patch mode.
+#
+# The following functions read each image once and slide a window over it:
+# the patches are views of the image tensor (no copy), gathered in batches of
+# `batch_size` patches which may contain the patches of consecutive sessions,
+# so that every batch given to the network is full. The outputs of an
+# autoencoder are added back at the position of their patch, and the voxels
+# covered by several patches (when `stride_size` is smaller than
+# `patch_size`) are averaged. Only the sessions whose patches are in the
+# current batch are kept in memory.
+
+# %%
+import itertools
+
+import nibabel as nib
+
+
+def patch_corners(image_size, patch_size, stride_size):
+    """Corners (d, h, w) of the patches of an image of size (D, H, W), ordered as the patch indices of ClinicaDL."""
+    return list(itertools.product(*[range(0, size - patch_size + 1, stride_size) for size in image_size]))
+
+
+def patch_batches(samples, preprocessing_dict, transformations=None, batch_size=64):
+    """
+    Gathers the patches of consecutive sessions in batches of batch_size patches.
+    :param samples: (iterable[dict]) samples of a CapsDatasetImage, one session at a time.
+    :return: (generator) batches of patches, with the (sample, patch index, corner, last patch) of each patch.
+    """
+    size, stride = preprocessing_dict["patch_size"], preprocessing_dict["stride_size"]
+    patches, keys = [], []
+    for sample in samples:
+        image = sample["image"]
+        corners = patch_corners(image.shape[1:], size, stride)
+        for patch_index, (d, h, w) in enumerate(corners):
+            patch = image[:, d:d + size, h:h + size, w:w + size]
+            patches.append(transformations(patch) if transformations else patch)
+            keys.append((sample, patch_index, (d, h, w), patch_index == len(corners) - 1))
+            if len(patches) == batch_size:
+                yield torch.stack(patches), keys
+                patches, keys = [], []
+    if patches:
+        yield torch.stack(patches), keys
+
+
+class PatchStitcher:
+    """Adds the patches of an image at their position, and averages the voxels covered by several patches."""
+    def __init__(self, image_size, patch_size):
+        self.patch_size = patch_size
+        self.sum = torch.zeros(image_size)
+        self.count = torch.zeros(image_size[1:])
+
+    def add(self, patch, corner):
+        d, h, w = corner
+        size = self.patch_size
+        self.sum[:, d:d + size, h:h + size, w:w + size] += patch
+        self.count[d:d + size, h:h + size, w:w + size] += 1
+
+    def volume(self):
+        """The stitched image; the voxels covered by no patch are 0."""
+        return self.sum / self.count.clamp(min=1)
+
+
+# %% [markdown]
+# The prediction writes the patch-level TSV file, and the image-level TSV file
+# for classification, as `clinicadl predict`. With `save_nifti`, the inputs and
+# the outputs of an autoencoder are stitched and written in
+# `<data_group>/nifti_images/<participant_id>_<session_id>_image_{input,output}.nii.gz`,
+# with the names used by `clinicadl predict --save_nifti` in image mode. As the
+# patches are normalized one by one during the training, the stitched input is
+# made of the normalized patches.
+
+# %%
+def predict_patches(
+    maps_manager,
+    data_group,
+    caps_directory,
+    participants_tsv,
+    split=0,
+    selection_metric="loss",
+    batch_size=64,
+    n_proc=2,
+    gpu=False,
+    use_labels=True,
+    save_nifti=False,
+):
+    """
+    Predicts the outputs of a single-network patch-level MAPS with a sliding window.
+    :param batch_size: (int) number of patches given to the network at once.
+    :param save_nifti: (bool) if True the reconstructed images of an autoencoder are written in NIfTI format.
+    :return: (DataFrame) the patch-level predictions.
+    """
+    if maps_manager.mode != "patch" or maps_manager.multi_network:
+        raise ValueError("predict_patches is only implemented for single-network MAPS in patch mode.")
+    task_manager = maps_manager.task_manager
+    reconstruction = maps_manager.network_task == "reconstruction"
+    group_df = load_data_test(Path(participants_tsv), maps_manager.diagnoses)
+    image_dataset = CapsDatasetImage(
+        Path(caps_directory),
+        group_df,
+        maps_manager.preprocessing_dict,
+        label_presence=use_labels,
+        label=maps_manager.label,
+        label_code=maps_manager.label_code,
+    )
+    _, all_transforms = get_transforms(
+        normalize=maps_manager.normalize,
+        size_reduction=maps_manager.size_reduction,
+        size_reduction_factor=maps_manager.size_reduction_factor,
+    )
+    # Without automatic batching, the workers read one session at a time
+    loader = DataLoader(image_dataset, batch_size=None, num_workers=n_proc)
+    model = load_network(maps_manager, split, selection_metric, gpu=gpu)
+
+    performance_dir = maps_manager.maps_path / f"split-{split}" / f"best-{selection_metric}" / data_group
+    nifti_dir = performance_dir / "nifti_images"
+    if save_nifti:
+        if not reconstruction:
+            raise ValueError("Only the outputs of an autoencoder can be written in NIfTI format.")
+        nifti_dir.mkdir(parents=True, exist_ok=True)
+
+    patch_size = maps_manager.preprocessing_dict["patch_size"]
+    stitchers = dict()
+    rows = []
+    with torch.no_grad():
+        for patches, keys in patch_batches(loader, maps_manager.preprocessing_dict, all_transforms, batch_size):
+            outputs = model.predict(patches.to(model.device, non_blocking=True)).float().cpu()
+            data = {
+                "image": patches,
+                "participant_id": [sample["participant_id"] for sample, *_ in keys],
+                "session_id": [sample["session_id"] for sample, *_ in keys],
+                "patch_id": torch.tensor([patch_index for _, patch_index, *_ in keys]),
+                "label": torch.tensor([sample["label"] if use_labels else -1 for sample, *_ in keys]),
+            }
+            for idx in range(len(outputs)):
+                rows += task_manager.generate_test_row(idx, data, outputs)
+            if not save_nifti:
+                continue
+            for idx, (sample, _, corner, last) in enumerate(keys):
+                session = (sample["participant_id"], sample["session_id"])
+                if session not in stitchers:
+                    image_size = sample["image"].shape
+                    stitchers[session] = (PatchStitcher(image_size, patch_size), PatchStitcher(image_size, patch_size))
+                stitchers[session][0].add(patches[idx], corner)
+                stitchers[session][1].add(outputs[idx], corner)
+                if last:
+                    for stitcher, suffix in zip(stitchers.pop(session), ["input", "output"]):
+                        nib.save(
+                            nib.Nifti1Image(stitcher.volume()[0].numpy(), np.eye(4)),
+                            nifti_dir / f"{session[0]}_{session[1]}_image_{suffix}.nii.gz",
+                        )
+
+    mode_df = pd.DataFrame(rows, columns=task_manager.columns)
+    metrics = task_manager.compute_metrics(mode_df, report_ci=False) if use_labels or reconstruction else None
+    write_predictions(maps_manager, data_group, split, selection_metric, "patch", mode_df, metrics)
+    if not reconstruction:
+        validation_df = maps_manager.get_prediction("validation", split, selection_metric, "patch")
+        image_df, image_metrics = task_manager.ensemble_prediction(
+            mode_df.copy(),
+            validation_df.reset_index(),
+            selection_threshold=maps_manager.selection_threshold,
+            use_labels=use_labels,
+        )
+        write_predictions(maps_manager, data_group, split, selection_metric, "image", image_df, image_metrics)
+    return mode_df
+
+
+# %% [markdown]
+# The next cell predicts the test set with the 3D patch-level autoencoder of
+# the [reconstruction notebook](./training_reconstruction.ipynb), and writes the
+# reconstructed images:
+
+# %%
+maps_manager = MapsManager(Path("data_adni/maps_reconstruction_3D_patch"))
+patch_df = predict_patches(
+    maps_manager,
+    "test-adni-stitched",
+    "data_adni/CAPS_example",
+    "data_adni/split/test_baseline.tsv",
+    gpu=gpu,
+    save_nifti=True,
+)
+patch_df.head()
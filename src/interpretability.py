@@ -14,6 +14,7 @@
 # %%
 # Uncomment this cell if running in Google Colab
 # !pip install clinicadl==1.6.1
+# !curl -k https://raw.githubusercontent.com/aramis-lab/clinicadl_handbook/main/notebooks/handbook_utils.py -o handbook_utils.py
 # %% [markdown]
 # # Generate saliency maps on trained networks
 
@@ -167,4 +168,707 @@ plot_individual_maps("CN", "AD")
 # The group saliency maps are very noisy and may be difficult to interpret but
 # individual maps are less noisy as the individual differences are less present
 # and we can see more easily the main pattern.
+
+# %% [markdown]
+# ## Interpret a whole data group in batches
+#
+# To interpret a large data group, most of the time is spent in the backward
+# passes. The following functions compute the saliency maps of a whole batch
+# with a single backward pass: the outputs of the target node of all the
+# images are summed before the backward. As the network is in evaluation
+# mode, the images of a batch do not interact, so the gradient of this sum
+# with respect to an image is the gradient of its own output.
+#
+# Two other methods average the gradients of several modified copies of each
+# image: [integrated gradients](https://arxiv.org/abs/1703.01365) along the
+# path from a black image to the image, and
+# [SmoothGrad](https://arxiv.org/abs/1706.03825) around the image with
+# gaussian noise. All the copies of all the images of a batch are evaluated
+# with a single forward and backward pass, so the memory needed is
+# `n_steps` times the one of the gradients: reduce the batch size accordingly.
+#
+# The target node can be the same for all the images (`target_node`), or the
+# label of each image (`target_node=None`). The maps are summed on the device
+# of the network, so the mean map of each location is computed without any
+# transfer to the CPU until the end.
+#
+# ```{note}
+# For 3D images, the Grad-CAM of ClinicaDL 1.6.1 averages the gradients of
+# the feature maps over two spatial dimensions only. Here the gradients are
+# averaged over all the spatial dimensions, as in the original description of
+# [Grad-CAM](https://arxiv.org/abs/1610.02391), so the maps of 3D images can
+# differ from the ones of `clinicadl interpret`.
+# ```
+
+# %%
+from pathlib import Path
+
+import torch
+from torch.nn.functional import interpolate
+from torch.utils.data import DataLoader
+
+from clinicadl import MapsManager
+from clinicadl.utils.caps_dataset.data import get_transforms, load_data_test, return_dataset
+from handbook_utils import load_network
+
+
+def input_gradients(model, images, targets):
+    """Gradients of the target output of each image with respect to this image, with one backward pass."""
+    images = images.detach().requires_grad_(True)
+    outputs = model(images)
+    outputs.gather(1, targets).sum().backward()
+    return images.grad
+
+
+def saliency_maps(model, images, targets, method="gradients", level=None, n_steps=20, noise_level=0.15):
+    """
+    Computes the saliency maps of a batch of images with a single backward pass.
+    :param model: (CNN) the network, in evaluation mode.
+    :param images: (Tensor) batch of images, on the device of the network.
+    :param targets: (Tensor) index of the output node of each image.
+    :param method: (str) gradients, grad-cam, integrated-gradients or smoothgrad.
+    :param level: (int) number of convolution layers before the feature maps of grad-cam, by default all of them.
+    :param n_steps: (int) number of interpolation steps of integrated-gradients, or of noisy copies of smoothgrad.
+    :param noise_level: (float) standard deviation of the noise of smoothgrad, relative to the range of each image.
+    :return: (Tensor) the maps, of the size of the images (with one channel for grad-cam).
+    """
+    targets = targets.view(-1, 1).to(images.device)
+    if method == "gradients":
+        return input_gradients(model, images, targets)
+    if method in ["integrated-gradients", "smoothgrad"]:
+        # all the steps of all the images are computed as a single batch of size len(images) * n_steps
+        if method == "integrated-gradients":
+            # midpoint Riemann sum along the path from a black image
+            alphas = (torch.arange(n_steps, device=images.device) + 0.5) / n_steps
+            inputs = alphas.view((1, n_steps) + (1,) * (images.dim() - 1)) * images.unsqueeze(1)
+        else:
+            dims = list(range(1, images.dim()))
+            sigma = noise_level * (images.amax(dim=dims) - images.amin(dim=dims))
+            noise = torch.randn((len(images), n_steps) + images.shape[1:], device=images.device)
+            inputs = images.unsqueeze(1) + sigma.view((-1,) + (1,) * images.dim()) * noise
+        gradients = input_gradients(model, inputs.flatten(0, 1), targets.repeat_interleave(n_steps, dim=0))
+        mean_gradients = gradients.view_as(inputs).mean(dim=1)
+        return images * mean_gradients if method == "integrated-gradients" else mean_gradients
+    if method != "grad-cam":
+        raise NotImplementedError(
+            f"Interpretation method {method} is not implemented. "
+            "Please choose in gradients, grad-cam, integrated-gradients, smoothgrad."
+        )
+
+    n_layers = len(model.convolutions) if level is None else level
+    with torch.no_grad():
+        feature_maps = model.convolutions[:n_layers](images)
+    feature_maps.requires_grad_(True)
+    outputs = model.fc(model.convolutions[n_layers:](feature_maps))
+    outputs.gather(1, targets).sum().backward()
+    spatial_dims = list(range(2, feature_maps.dim()))
+    weights = feature_maps.grad.mean(dim=spatial_dims, keepdim=True)
+    grad_cam = (feature_maps.detach() * weights).mean(dim=1, keepdim=True)
+    return interpolate(
+        grad_cam, size=images.shape[2:], mode="bilinear" if images.dim() == 4 else "trilinear", align_corners=True
+    )
+
+
+# %% [markdown]
+# The individual maps are not kept in memory to compute the group maps: the
+# mean and the variance of the maps of each location are updated after each
+# batch with the parallel version of
+# [Welford's algorithm](https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm).
+# The statistics of the batch are merged with the running ones, so the memory
+# used is a few volumes per location, whatever the size of the data group.
+
+# %%
+class RunningMaps:
+    """Running mean and variance of the maps of each location."""
+
+    def __init__(self, n_locations, map_shape, device="cpu"):
+        self.count = torch.zeros(n_locations, device=device)
+        self.mean = torch.zeros((n_locations,) + tuple(map_shape), device=device)
+        self.m2 = torch.zeros_like(self.mean)
+
+    def update(self, location_ids, maps):
+        """
+        Merges the statistics of a batch of maps with the running ones.
+        :param location_ids: (LongTensor) index of the location of each map, from 0.
+        :param maps: (Tensor) batch of maps.
+        """
+        maps = maps.float()
+        batch_count = torch.bincount(location_ids, minlength=len(self.count)).float()
+        batch_mean = torch.zeros_like(self.mean).index_add_(0, location_ids, maps)
+        batch_mean /= self._expand(batch_count.clamp(min=1))
+        batch_m2 = torch.zeros_like(self.m2).index_add_(0, location_ids, (maps - batch_mean[location_ids]) ** 2)
+
+        total = self.count + batch_count
+        delta = batch_mean - self.mean
+        self.mean += delta * self._expand(batch_count / total.clamp(min=1))
+        self.m2 += batch_m2 + delta**2 * self._expand(self.count * batch_count / total.clamp(min=1))
+        self.count = total
+
+    def variance(self):
+        """:return: (Tensor) unbiased variance of the maps of each location."""
+        return self.m2 / self._expand((self.count - 1).clamp(min=1))
+
+    def _expand(self, values):
+        return values.view((-1,) + (1,) * (self.mean.dim() - 1))
+
+
+# %% [markdown]
+# To screen many maps without plotting them, the maps can be summarized in the
+# regions of an atlas: a label image of the size of the maps, where each voxel
+# holds the index of its region (0 for the background). The sum, mean and
+# maximum of each region are computed for a whole batch of maps at once, by
+# scattering the values of the voxels to the index of their region.
+
+# %%
+import nibabel as nib
+import pandas as pd
+
+
+def load_atlas(atlas_path, device="cpu"):
+    """
+    Loads a label image as region indices.
+    :param atlas_path: (str) path to the NIfTI label image.
+    :return: (LongTensor) the index of the region of each voxel (0 for the background), and the (ndarray) region labels.
+    """
+    labels = torch.from_numpy(nib.load(atlas_path).get_fdata().round()).long()
+    region_labels, region_indices = torch.unique(labels, return_inverse=True)
+    if region_labels[0] != 0:
+        region_labels = torch.cat([torch.zeros(1, dtype=torch.long), region_labels])
+        region_indices += 1
+    return region_indices.to(device), region_labels[1:].numpy()
+
+
+def region_statistics(maps, region_indices, n_regions):
+    """
+    Computes the statistics of a batch of maps in the regions of an atlas.
+    :param maps: (Tensor) batch of maps, whose last dimensions have the size of the atlas.
+    :param region_indices: (LongTensor) index of the region of each voxel, as returned by load_atlas.
+    :param n_regions: (int) number of regions, without the background.
+    :return: (dict) the sum, mean and max of each map in each region, as (n_maps, n_regions) tensors.
+    """
+    if maps.shape[-region_indices.dim():] != region_indices.shape:
+        raise ValueError(f"The size of the atlas {tuple(region_indices.shape)} does not match the maps {tuple(maps.shape)}.")
+    values = maps.float().reshape(len(maps), -1)
+    # the channels of a map are summarized together
+    index = region_indices.flatten().repeat(values.shape[1] // region_indices.numel()).expand_as(values)
+    sums = torch.zeros(len(maps), n_regions + 1, device=maps.device).scatter_add_(1, index, values)
+    counts = torch.bincount(index[0], minlength=n_regions + 1)
+    maxima = torch.full_like(sums, -torch.inf).scatter_reduce_(1, index, values, "amax")
+    return {"sum": sums[:, 1:], "mean": sums[:, 1:] / counts[1:].clamp(min=1), "max": maxima[:, 1:]}
+
+
+def statistics_df(statistics, region_labels, **columns):
+    """
+    Converts the output of region_statistics to a long DataFrame, with one row per map and region.
+    :param columns: values of the other columns, one per map.
+    """
+    n_maps, n_regions = statistics["sum"].shape
+    df = pd.DataFrame({key: [v for v in values for _ in range(n_regions)] for key, values in columns.items()})
+    df["region"] = list(region_labels) * n_maps
+    for name, values in statistics.items():
+        df[name] = values.cpu().flatten().numpy()
+    return df
+
+
+# %%
+def group_dataset(maps_manager, caps_directory, participants_tsv, label_presence=False):
+    """
+    Loads the images of a data group with the preprocessing and transforms of a MAPS.
+    :return: the (DataFrame) list of sessions and the (CapsDataset) dataset.
+    """
+    group_df = load_data_test(Path(participants_tsv), maps_manager.diagnoses)
+    _, all_transforms = get_transforms(
+        normalize=maps_manager.normalize,
+        size_reduction=maps_manager.size_reduction,
+        size_reduction_factor=maps_manager.size_reduction_factor,
+    )
+    dataset = return_dataset(
+        Path(caps_directory),
+        group_df,
+        maps_manager.preprocessing_dict,
+        all_transformations=all_transforms,
+        label=maps_manager.label,
+        label_code=maps_manager.label_code,
+        label_presence=label_presence,
+    )
+    return group_df, dataset
+
+
+# %% [markdown]
+# Writing one file per individual map is slow for thousands of sessions. The
+# maps can instead be appended to a single store: each map is cut in chunks of
+# a few slices along its first spatial dimension, and each chunk is compressed
+# separately. An index gives the position of each chunk in the file, so that a
+# map, or a range of slices, can be read without decompressing the others. The
+# index is written as the maps are added, so that the maps stored before an
+# interruption of a long run can still be read.
+# The maps can be stored in `float16` to halve the size, at the cost of the
+# precision of the smallest values.
+
+# %%
+import json
+import zlib
+
+import numpy as np
+
+
+class MapStore:
+    """Appends maps to a single file of compressed chunks, indexed by participant, session and location."""
+
+    def __init__(self, store_path, dtype="float32", chunk_size=8, compression_level=1):
+        """
+        :param store_path: (Path) directory of the store.
+        :param dtype: (str) type in which the maps are stored, float32 or float16.
+        :param chunk_size: (int) number of slices along the first spatial dimension of a chunk.
+        :param compression_level: (int) zlib compression level.
+        """
+        self.store_path = Path(store_path)
+        self.store_path.mkdir(parents=True, exist_ok=True)
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.compression_level = compression_level
+        self.shape = None
+        self._file = (self.store_path / "chunks.bin").open("wb")
+        self._index_file = (self.store_path / "index.tsv").open("w")
+        self._index_file.write("participant_id\tsession_id\tmode_id\tchunk\toffset\tlength\n")
+
+    def add(self, participant_id, session_id, mode_id, individual_map):
+        array = individual_map.cpu().numpy().astype(self.dtype)
+        if self.shape is None:
+            self.shape = array.shape
+            with (self.store_path / "metadata.json").open("w") as f:
+                json.dump({"shape": self.shape, "dtype": self.dtype, "chunk_size": self.chunk_size}, f)
+        for chunk, start in enumerate(range(0, array.shape[1], self.chunk_size)):
+            data = zlib.compress(np.ascontiguousarray(array[:, start : start + self.chunk_size]), self.compression_level)
+            self._index_file.write(f"{participant_id}\t{session_id}\t{mode_id}\t{chunk}\t{self._file.tell()}\t{len(data)}\n")
+            self._file.write(data)
+
+    def flush(self):
+        """Writes the maps added so far, the chunks before the index entries pointing to them."""
+        self._file.flush()
+        self._index_file.flush()
+
+    def close(self):
+        self._file.close()
+        self._index_file.close()
+
+
+# %% [markdown]
+# The next function interprets a data group with these batched maps. It writes
+# the mean and variance maps of each location (and the individual maps with
+# `save_individual=True`, or in a `MapStore` with `save_individual="store"`)
+# with the names used by `clinicadl interpret`, in
+# `split-<i>/best-<metric>/<data_group>/interpret-<name>`. With `group_by`, the
+# group maps of each value of this column of the TSV file (for example each
+# diagnosis) are computed in the same run, and written in a subfolder
+# `<group_by>-<value>`. With an `atlas`, the statistics of each individual map
+# and of each mean map are written in `region_statistics.tsv` and
+# `group_region_statistics.tsv`.
+
+# %%
+def interpret_batched(
+    maps_manager,
+    data_group,
+    name,
+    method,
+    caps_directory,
+    participants_tsv,
+    split=0,
+    selection_metric="loss",
+    target_node=0,
+    level=None,
+    batch_size=8,
+    n_proc=2,
+    gpu=False,
+    save_individual=False,
+    group_by=None,
+    atlas=None,
+    n_steps=20,
+    noise_level=0.15,
+    store_dtype="float32",
+):
+    """
+    Computes the saliency maps of a data group by batches, and their mean and variance for each location.
+    :param target_node: (int) output node from which the gradients are computed, or None to use the label of each image.
+    :param save_individual: (bool or str) True to save each map in a file, "store" to save them in a single MapStore.
+    :param group_by: (str) column of the TSV file defining subgroups whose maps are also computed, or None.
+    :param atlas: (str) path to a label image of the size of the maps to compute region statistics, or None.
+    :param n_steps: (int) number of steps of integrated-gradients and smoothgrad, see saliency_maps.
+    :param store_dtype: (str) type of the maps in the MapStore, float32 or float16.
+    :return: (dict) the RunningMaps of the whole data group (key None) and of each subgroup.
+    """
+    mode = maps_manager.mode
+    results_path = (
+        maps_manager.maps_path / f"split-{split}" / f"best-{selection_metric}" / data_group / f"interpret-{name}"
+    )
+    results_path.mkdir(parents=True, exist_ok=True)
+    group_df, dataset = group_dataset(maps_manager, caps_directory, participants_tsv, label_presence=target_node is None)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=n_proc, pin_memory=gpu)
+    model = load_network(maps_manager, split, selection_metric, gpu=gpu)
+
+    if group_by is not None:
+        group_values = group_df.set_index(["participant_id", "session_id"])[group_by]
+
+    if atlas is not None:
+        region_indices, region_labels = load_atlas(atlas, model.device)
+        individual_dfs = []
+
+    if save_individual == "store":
+        map_store = MapStore(results_path / "individual_maps", dtype=store_dtype)
+
+    # slice ids start after the discarded slices
+    first_id = dataset.discarded_slices[0] if mode == "slice" else 0
+    group_maps = {}
+    for data in loader:
+        images = data["image"].to(model.device, non_blocking=True)
+        targets = data["label"] if target_node is None else torch.full((len(images),), target_node)
+        maps = saliency_maps(model, images, targets, method, level, n_steps, noise_level).detach()
+        mode_ids = data[f"{mode}_id"].to(model.device)
+        if not group_maps:
+            group_maps[None] = RunningMaps(dataset.elem_per_image, maps.shape[1:], model.device)
+        group_maps[None].update(mode_ids - first_id, maps)
+        if group_by is not None:
+            batch_values = [
+                group_values[participant_id, session_id]
+                for participant_id, session_id in zip(data["participant_id"], data["session_id"])
+            ]
+            for value in set(batch_values):
+                indices = torch.tensor([i for i, v in enumerate(batch_values) if v == value], device=model.device)
+                if value not in group_maps:
+                    group_maps[value] = RunningMaps(dataset.elem_per_image, maps.shape[1:], model.device)
+                group_maps[value].update(mode_ids[indices] - first_id, maps[indices])
+        if atlas is not None:
+            statistics = region_statistics(maps, region_indices, len(region_labels))
+            individual_dfs.append(
+                statistics_df(
+                    statistics,
+                    region_labels,
+                    participant_id=data["participant_id"],
+                    session_id=data["session_id"],
+                    **{f"{mode}_id": mode_ids.tolist()},
+                )
+            )
+        if save_individual:
+            for participant_id, session_id, mode_id, individual_map in zip(
+                data["participant_id"], data["session_id"], mode_ids.tolist(), maps.cpu()
+            ):
+                if save_individual == "store":
+                    map_store.add(participant_id, session_id, mode_id, individual_map)
+                else:
+                    # clone to save the map without the storage of the whole batch
+                    torch.save(
+                        individual_map.clone(), results_path / f"{participant_id}_{session_id}_{mode}-{mode_id}_map.pt"
+                    )
+            if save_individual == "store":
+                map_store.flush()
+    if save_individual == "store":
+        map_store.close()
+
+    for value, running_maps in group_maps.items():
+        group_path = results_path if value is None else results_path / f"{group_by}-{value}"
+        group_path.mkdir(exist_ok=True)
+        for mode_id, (mean_map, variance_map) in enumerate(
+            zip(running_maps.mean.cpu(), running_maps.variance().cpu()), start=first_id
+        ):
+            # clone to save each map without the storage of all the locations
+            torch.save(mean_map.clone(), group_path / f"mean_{mode}-{mode_id}_map.pt")
+            torch.save(variance_map.clone(), group_path / f"variance_{mode}-{mode_id}_map.pt")
+
+    if atlas is not None:
+        pd.concat(individual_dfs).to_csv(results_path / "region_statistics.tsv", sep="\t", index=False)
+        group_dfs = [
+            statistics_df(
+                region_statistics(running_maps.mean, region_indices, len(region_labels)),
+                region_labels,
+                group=["all" if value is None else f"{group_by}-{value}"] * len(running_maps.mean),
+                **{f"{mode}_id": range(first_id, first_id + len(running_maps.mean))},
+            )
+            for value, running_maps in group_maps.items()
+        ]
+        pd.concat(group_dfs).to_csv(results_path / "group_region_statistics.tsv", sep="\t", index=False)
+    return group_maps
+
+
+# %% [markdown]
+# The next cell computes the Grad-CAM maps of the AD images of the trivial
+# dataset, based on the CN node, as the first `clinicadl interpret` command
+# of this notebook:
+
+# %%
+maps_manager = MapsManager(Path("interpret/maps_trivial"))
+group_maps = interpret_batched(
+    maps_manager,
+    "test-gc-batched",
+    "gc_AD",
+    "grad-cam",
+    "interpret/caps_trivial_tensor",
+    "interpret/caps_trivial_tensor/data.tsv",
+    target_node=1,
+    batch_size=8,
+    gpu=torch.cuda.is_available(),
+)
+group_maps[None].mean.shape
+
+
+# %% [markdown]
+# The next cell computes the gradients maps of the whole trivial dataset based
+# on the label of each image, with the group maps of each diagnosis. The
+# standard deviation shows where the individual maps of a group agree:
+
+# %%
+group_maps = interpret_batched(
+    maps_manager,
+    "test-gd-batched",
+    "gd_label",
+    "gradients",
+    "interpret/caps_trivial_tensor",
+    "interpret/caps_trivial_tensor/data.tsv",
+    target_node=None,
+    batch_size=8,
+    gpu=torch.cuda.is_available(),
+    group_by="diagnosis",
+)
+for diagnosis in ["AD", "CN"]:
+    running_maps = group_maps[diagnosis]
+    print(
+        f"{diagnosis}: {int(running_maps.count[0])} images, "
+        f"mean std {running_maps.variance().sqrt().mean().item():.3g}"
+    )
+
+
+# %% [markdown]
+# The masks used to generate the trivial dataset can be merged in a label
+# image, to check that the maps of each diagnosis focus on the atrophied
+# regions (region 3 is the overlap of both masks, if any):
+
+# %%
+mask_1 = nib.load("AAL2/mask-1.nii")
+mask_2 = nib.load("AAL2/mask-2.nii")
+atlas = (mask_1.get_fdata() > 0) + 2 * (mask_2.get_fdata() > 0)
+nib.save(nib.Nifti1Image(atlas.astype(np.int16), mask_1.affine), "AAL2/trivial_atlas.nii.gz")
+
+interpret_batched(
+    maps_manager,
+    "test-gd-batched",
+    "gd_label_atlas",
+    "gradients",
+    "interpret/caps_trivial_tensor",
+    "interpret/caps_trivial_tensor/data.tsv",
+    target_node=None,
+    batch_size=8,
+    gpu=torch.cuda.is_available(),
+    group_by="diagnosis",
+    atlas="AAL2/trivial_atlas.nii.gz",
+)
+results_path = maps_manager.maps_path / "split-0" / "best-loss" / "test-gd-batched" / "interpret-gd_label_atlas"
+group_df = pd.read_csv(results_path / "group_region_statistics.tsv", sep="\t")
+group_df.pivot(index="group", columns="region", values="mean")
+
+
+# %% [markdown]
+# ## Cost of the attribution methods
+#
+# Integrated gradients and SmoothGrad are more robust than the gradients, but
+# cost `n_steps` forward and backward passes per image. The next function
+# measures the time and the peak memory needed per image by each method on a
+# sample of a data group, to choose the methods and the number of steps that
+# fit your computational budget. The peak memory is measured with the
+# `PeakMemory` context of the [training performance](training_performance.ipynb)
+# notebook, imported from `handbook_utils.py`.
+
+# %%
+from time import perf_counter
+
+from torch.utils.data import Subset
+
+from handbook_utils import PeakMemory
+
+
+def attribution_costs(
+    maps_manager,
+    caps_directory,
+    participants_tsv,
+    methods=("gradients", "grad-cam", "integrated-gradients", "smoothgrad"),
+    n_steps=20,
+    batch_size=4,
+    n_images=16,
+    split=0,
+    selection_metric="loss",
+    target_node=0,
+    gpu=False,
+):
+    """
+    Measures the time and the peak memory per image of attribution methods.
+    :param n_images: (int) number of images of the data group on which the methods are timed.
+    :return: (DataFrame) the cost of each method.
+    """
+    _, dataset = group_dataset(maps_manager, caps_directory, participants_tsv)
+    dataset = Subset(dataset, range(min(n_images, len(dataset))))
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=0)
+    model = load_network(maps_manager, split, selection_metric, gpu=gpu)
+    batches = [data["image"].to(model.device) for data in loader]
+
+    rows = []
+    for method in methods:
+        targets = torch.full((len(batches[0]),), target_node)
+        # warm-up, not timed
+        saliency_maps(model, batches[0], targets, method, n_steps=n_steps)
+        with PeakMemory(model.device) as memory:
+            start = perf_counter()
+            for images in batches:
+                targets = torch.full((len(images),), target_node)
+                saliency_maps(model, images, targets, method, n_steps=n_steps).cpu()
+            duration = perf_counter() - start
+        rows.append(
+            {
+                "method": method,
+                "n_steps": n_steps if method in ["integrated-gradients", "smoothgrad"] else 1,
+                "time_per_image_ms": 1000 * duration / len(dataset),
+                "peak_memory_per_image_MiB": memory.peak / len(batches[0]),
+            }
+        )
+    return pd.DataFrame(rows).set_index("method")
+
+
+# %%
+attribution_costs(
+    maps_manager,
+    "interpret/caps_trivial_tensor",
+    "interpret/caps_trivial_tensor/data.tsv",
+    n_steps=20,
+    batch_size=2,
+    gpu=torch.cuda.is_available(),
+)
+
+
+
+# %% [markdown]
+# ## Read the individual maps of a store
+#
+# The next class reads the maps of a `MapStore`. Only the chunks covering the
+# requested slices are read and decompressed, and a map can be exported to
+# NIfTI when needed, as the individual maps of `clinicadl interpret`.
+
+# %%
+class MapStoreReader:
+    """Reads the maps of a MapStore, or ranges of their slices."""
+
+    def __init__(self, store_path):
+        self.store_path = Path(store_path)
+        with (self.store_path / "metadata.json").open() as f:
+            metadata = json.load(f)
+        self.shape = tuple(metadata["shape"])
+        self.dtype = metadata["dtype"]
+        self.chunk_size = metadata["chunk_size"]
+        self.index = (
+            pd.read_csv(self.store_path / "index.tsv", sep="\t")
+            .set_index(["participant_id", "session_id", "mode_id", "chunk"])
+            .sort_index()
+        )
+
+    def keys(self):
+        """:return: (list) the (participant_id, session_id, mode_id) of the stored maps."""
+        return self.index.index.droplevel("chunk").unique().tolist()
+
+    def read(self, participant_id, session_id, mode_id=0, start=0, stop=None):
+        """
+        Reads a map, or a range of its slices along the first spatial dimension.
+        :param start: (int) first slice read.
+        :param stop: (int) slice after the last slice read, by default the end of the map.
+        :return: (Tensor) the map (or its slices) in float32, empty if start >= stop.
+        """
+        stop = self.shape[1] if stop is None else min(stop, self.shape[1])
+        if start >= stop:
+            return torch.empty((self.shape[0], 0) + self.shape[2:])
+        first_chunk, last_chunk = start // self.chunk_size, (stop - 1) // self.chunk_size
+        chunks = []
+        with (self.store_path / "chunks.bin").open("rb") as f:
+            for chunk in range(first_chunk, last_chunk + 1):
+                offset, length = self.index.loc[(participant_id, session_id, mode_id, chunk), ["offset", "length"]]
+                f.seek(offset)
+                chunk_array = np.frombuffer(zlib.decompress(f.read(length)), dtype=self.dtype)
+                chunks.append(chunk_array.reshape((self.shape[0], -1) + self.shape[2:]))
+        array = np.concatenate(chunks, axis=1)[:, start - first_chunk * self.chunk_size : stop - first_chunk * self.chunk_size]
+        return torch.from_numpy(array.astype(np.float32))
+
+    def to_nifti(self, participant_id, session_id, nifti_path, mode_id=0, affine=None):
+        """
+        Exports a map to NIfTI.
+        :param affine: (ndarray) affine of the image, by default the identity as in clinicadl interpret.
+        """
+        individual_map = self.read(participant_id, session_id, mode_id)
+        nib.save(nib.Nifti1Image(individual_map.numpy(), np.eye(4) if affine is None else affine), nifti_path)
+
+
+# %% [markdown]
+# The next cell stores the gradients maps of the trivial dataset in `float16`,
+# then reads the 10 central slices of the first map and exports it to NIfTI:
+
+# %%
+interpret_batched(
+    maps_manager,
+    "test-gd-batched",
+    "gd_store",
+    "gradients",
+    "interpret/caps_trivial_tensor",
+    "interpret/caps_trivial_tensor/data.tsv",
+    batch_size=8,
+    gpu=torch.cuda.is_available(),
+    save_individual="store",
+    store_dtype="float16",
+)
+reader = MapStoreReader(
+    maps_manager.maps_path / "split-0" / "best-loss" / "test-gd-batched" / "interpret-gd_store" / "individual_maps"
+)
+participant_id, session_id, mode_id = reader.keys()[0]
+central_slices = reader.read(participant_id, session_id, mode_id, start=reader.shape[1] // 2 - 5, stop=reader.shape[1] // 2 + 5)
+print(central_slices.shape)
+reader.to_nifti(participant_id, session_id, f"{participant_id}_{session_id}_map.nii.gz", mode_id)
+
+
+# %% [markdown]
+# ## Review many maps at once
+#
+# Plotting each map with `plot_stat_map`, as in `plot_individual_maps`, is
+# too slow to review thousands of maps. The `render_contact_sheet` function of
+# `handbook_utils.py`, also used to review the preprocessed images in the
+# [preprocessing](preprocessing.ipynb) notebook, renders a thumbnail of the
+# three central slices of each map in a pool of processes, and gathers all the
+# thumbnails in an HTML contact sheet that can be opened in a browser. Only the
+# three slices are read from each map, as the tensors are memory-mapped.
+# Negative values are shown in blue and positive values in red.
+
+# %%
+from handbook_utils import render_contact_sheet
+
+
+def individual_maps(results_path):
+    """
+    Lists the individual maps written by interpret_batched (or clinicadl interpret) with save_individual.
+    :return: (DataFrame) the participant_id, session_id, mode_id (e.g. slice-3) and path of each map.
+    """
+    rows = []
+    for path in sorted(Path(results_path).glob("sub-*_map.pt")):
+        participant_id, session_id, mode_id = path.name.split("_")[:3]
+        rows.append({"participant_id": participant_id, "session_id": session_id, "mode_id": mode_id, "path": path})
+    return pd.DataFrame(rows, columns=["participant_id", "session_id", "mode_id", "path"])
+
+
 # %%
+results_path = maps_manager.maps_path / "split-0" / "best-loss" / "test-gd-batched" / "interpret-gd_individual"
+interpret_batched(
+    maps_manager,
+    "test-gd-batched",
+    "gd_individual",
+    "gradients",
+    "interpret/caps_trivial_tensor",
+    "interpret/caps_trivial_tensor/data.tsv",
+    target_node=None,
+    batch_size=8,
+    gpu=torch.cuda.is_available(),
+    save_individual=True,
+)
+maps_df = individual_maps(results_path).merge(
+    pd.read_csv("interpret/caps_trivial_tensor/data.tsv", sep="\t"), on=["participant_id", "session_id"]
+)
+render_contact_sheet(maps_df.sort_values("diagnosis"), results_path / "contact_sheet", cmap="diverging", captions=["diagnosis"])
@@ -13,8 +13,9 @@
 # ---
 
 # %%
-# Uncomment the next line if running in Google Colab
+# Uncomment the next lines if running in Google Colab
 # # !pip install clinicadl==1.6.1
+# # !curl -k https://raw.githubusercontent.com/aramis-lab/clinicadl_handbook/main/notebooks/handbook_utils.py -o handbook_utils.py
 
 # %% [markdown]
 # # Prepare your neuroimaging data
@@ -440,6 +441,49 @@ print(df_T1)
 df_pet = pd.read_csv("data_adni/QC_result_pet.tsv", sep="\t")
 print(df_pet)
 
+# %% [markdown]
+# ### Review many images at once
+#
+# Plotting each image with `plot_anat` is too slow to review thousands of
+# images. The `render_contact_sheet` function of `handbook_utils.py` renders a
+# thumbnail of the three central slices of each image in a pool of processes,
+# and gathers all the thumbnails in an HTML contact sheet that can be opened in
+# a browser. Only the three slices are read from each image: uncompressed
+# NIfTI images and tensors are memory-mapped, and compressed images are
+# decompressed until the last slice needed.
+
+# %%
+from pathlib import Path
+
+import pandas as pd
+
+from handbook_utils import render_contact_sheet
+
+
+def caps_images(caps_directory, pattern):
+    """
+    Lists the images of a CAPS.
+    :param pattern: (str) path of the image in the session folders, e.g. t1_linear/*_T1w.nii.gz, matching one image
+        per session.
+    :return: (DataFrame) the participant_id, session_id and path of each image.
+    """
+    subjects_path = Path(caps_directory) / "subjects"
+    rows = []
+    for path in sorted(subjects_path.glob(f"*/*/{pattern}")):
+        participant_id, session_id = path.relative_to(subjects_path).parts[:2]
+        rows.append({"participant_id": participant_id, "session_id": session_id, "path": path})
+    return pd.DataFrame(rows, columns=["participant_id", "session_id", "path"])
+
+
+# %% [markdown]
+# The contact sheet of the `t1-linear` images shows first the images with the
+# lowest probability of passing the quality check:
+
+# %%
+images_df = caps_images("data_oasis/CAPS_example", "t1_linear/*_T1w.nii.gz")
+images_df = images_df.merge(df_T1, on=["participant_id", "session_id"]).sort_values("pass_probability")
+render_contact_sheet(images_df, "data_oasis/QC_thumbnails", n_proc=4, captions=["pass_probability"])
+
 # %% [markdown]
 # Now that you have your preprocessed data, you can split them in order to 
 # prepare your training in the next notebook.
@@ -207,6 +207,585 @@ display(predictions)
 
 metrics = pd.read_csv("./random_search/maps_random_search/split-%i/best-loss/test_image_level_metrics.tsv" % split, sep="\t")
 display(metrics)
+# %% [markdown]
+# ## Estimate the cost of a random architecture
+#
+# A random architecture with many wide convolutional blocks can need more
+# memory than available, which is only discovered when its training fails,
+# or when its summary is printed as in the last section of this notebook.
+# The cost of an architecture can be computed from its sampled options and
+# the size of the input images, without building it:
+# - the number of parameters of the convolutions, normalization and
+# fully-connected layers,
+# - the FLOPs of a forward pass of an image in the convolutions and
+# fully-connected layers (2 FLOPs per multiply-add),
+# - the memory of the outputs of all the layers for an image, which are kept
+# for the backward pass during training (in float32).
+#
+# The memory needed for training is estimated as the outputs of the layers for
+# a batch, plus four copies of the parameters (weights, gradients and the two
+# moments of Adam).
+
+# %%
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import toml
+from clinicadl.utils.caps_dataset.data import get_transforms, return_dataset
+from clinicadl.utils.network.cnn.random import RandomArchitecture
+
+
+def architecture_cost(convolutions_dict, n_fcblocks, input_size, network_normalization="BatchNorm", output_size=2):
+    """
+    Computes the cost of a RandomArchitecture without building it.
+    :param convolutions_dict: (dict) description of the convolutional blocks, as sampled by the random search.
+    :param input_size: (list) size of an input image (C, [D,] H, W).
+    :return: (dict) number of parameters, forward GFLOPs and MiB of the outputs of the layers for one image.
+    """
+    kernel_size = 3 ** (len(input_size) - 1)
+    normalization = network_normalization in ["BatchNorm", "InstanceNorm"]
+    # InstanceNorm layers have no affine parameters by default
+    normalization_parameters = 2 if network_normalization == "BatchNorm" else 0
+    spatial_size = np.array(input_size[1:])
+    n_parameters, flops, n_outputs = 0, 0, int(np.prod(input_size))
+
+    for conv_dict in convolutions_dict.values():
+        in_channels = conv_dict["in_channels"] or input_size[0]
+        out_channels = conv_dict["out_channels"]
+        reduced_size = np.ceil(spatial_size / 2)
+        last_size = spatial_size if conv_dict["d_reduction"] == "MaxPooling" else reduced_size
+        layers = [(in_channels, in_channels, spatial_size)] * (conv_dict["n_conv"] - 1)
+        layers.append((in_channels, out_channels, last_size))
+        for layer_in, layer_out, layer_size in layers:
+            n_voxels = int(np.prod(layer_size))
+            n_parameters += layer_in * layer_out * kernel_size + layer_out + normalization_parameters * layer_out
+            flops += 2 * layer_in * kernel_size * layer_out * n_voxels
+            # convolution, normalization and activation
+            n_outputs += (3 if normalization else 2) * layer_out * n_voxels
+        if conv_dict["d_reduction"] == "MaxPooling":
+            # padding to an even size, then pooling
+            n_outputs += out_channels * int(np.prod(2 * reduced_size) + np.prod(reduced_size))
+        spatial_size = reduced_size
+
+    fc, _ = RandomArchitecture.fc_dict_design(n_fcblocks, convolutions_dict, input_size, output_size)
+    # flatten and dropout
+    n_outputs += 2 * fc["FC0"]["in_features"]
+    for i, fc_dict in enumerate(fc.values()):
+        n_parameters += fc_dict["in_features"] * fc_dict["out_features"] + fc_dict["out_features"]
+        flops += 2 * fc_dict["in_features"] * fc_dict["out_features"]
+        n_outputs += fc_dict["out_features"] * (1 if i == len(fc) - 1 else 2)
+
+    return {"n_parameters": n_parameters, "gflops": flops / 1e9, "activation_MiB": 4 * n_outputs / 2 ** 20}
+
+
+def training_memory(cost, batch_size):
+    """Estimates the memory in MiB needed to train an architecture of a given cost with Adam."""
+    return batch_size * cost["activation_MiB"] + 4 * 4 * cost["n_parameters"] / 2 ** 20
+
+
+# %% [markdown]
+# The budgets of the search are given in the `Random_Search` section of
+# `random_search.toml` (they are ignored by `clinicadl random-search`):
+# - `max_memory_MiB` (float) is the maximum memory estimated for training
+# with the batch size of the search,
+# - `max_gflops` (float) is the maximum number of GFLOPs of a forward pass
+# of an image.
+#
+# When a budget is given, the search samples the architecture of a trial
+# again until it fits the budgets. The input size is read from the
+# first image of the training set of the first split.
+
+# %%
+def architecture_budget(launch_directory, space_options):
+    """
+    Reads the budgets of the architectures in random_search.toml.
+    :return: (dict) the budgets, with the input and output sizes of the networks, or None if there is no budget.
+    """
+    search_options = toml.load(Path(launch_directory) / "random_search.toml")["Random_Search"]
+    budget = {key: search_options[key] for key in ["max_memory_MiB", "max_gflops"] if key in search_options}
+    if not budget:
+        return None
+
+    train_df = pd.read_csv(Path(space_options["tsv_path"]) / "split-0" / "train_baseline.tsv", sep="\t")
+    label = space_options["label"]
+    if space_options["network_task"] == "classification":
+        train_df = train_df[train_df[label].isin(space_options["diagnoses"])]
+    train_df["cohort"] = "single"
+    _, all_transforms = get_transforms(
+        normalize=space_options["normalize"],
+        size_reduction=space_options["size_reduction"],
+        size_reduction_factor=space_options["size_reduction_factor"],
+    )
+    dataset = return_dataset(
+        Path(space_options["caps_directory"]),
+        train_df.head(1).reset_index(drop=True),
+        space_options["preprocessing_dict"],
+        all_transformations=all_transforms,
+        label_presence=False,
+    )
+    budget["input_size"] = list(dataset.size)
+    budget["output_size"] = train_df[label].nunique() if space_options["network_task"] == "classification" else 1
+    budget["batch_size"] = space_options["batch_size"]
+    return budget
+
+
+def fits_budget(options, budget):
+    """Checks if the architecture sampled in options fits the budget."""
+    cost = architecture_cost(
+        options["convolutions_dict"],
+        options["n_fcblocks"],
+        budget["input_size"],
+        options["network_normalization"],
+        budget["output_size"],
+    )
+    return training_memory(cost, budget["batch_size"]) <= budget.get("max_memory_MiB", np.inf) and cost[
+        "gflops"
+    ] <= budget.get("max_gflops", np.inf)
+
+
+# %% [markdown]
+# ## Run many trials in parallel
+#
+# Each call to `clinicadl random-search` samples and trains a single network.
+# To explore the hyperparameter space, the next functions run a whole search:
+# the options of each trial are sampled from `random_search.toml` as in
+# `clinicadl random-search`, then the trials are trained concurrently by a
+# given number of workers. Each trial runs in its own process, with a budget
+# of CPU threads (and a GPU, if several are given), and its log is written in
+# its MAPS folder.
+#
+# The trials and their validation metrics are saved in a SQLite database,
+# `trials.sqlite`, in the folder of the search. If the search is interrupted,
+# the trials that were not started are cancelled, and the running trials,
+# interrupted too, are set back to pending. Running the search again trains
+# only the trials that were not finished: the trials are sampled with a seed
+# depending on their index, so their options are the same as before the
+# interruption. The failed trials are trained again with `retry_failed=True`.
+
+# %%
+import json
+import os
+import random
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+from queue import Queue
+
+import pandas as pd
+import toml
+from clinicadl.random_search.random_search_utils import get_space_dict, random_sampling
+
+# exit code of a trial stopped by the scheduler
+STOPPED = 3
+
+# script run in a new process to train a trial
+TRIAL_SCRIPT = """
+import json, sqlite3, sys, time
+from pathlib import Path
+import torch
+from clinicadl import MapsManager
+from clinicadl.utils.callbacks.callbacks import Callback
+from clinicadl.utils.preprocessing import path_decoder
+
+with open(sys.argv[1]) as f:
+    trial = json.load(f)
+torch.set_num_threads(trial["n_threads"])
+options = path_decoder(trial["options"])
+split_list = options.pop("split")
+# a single split is trained without cross-validation (n_splits = 0)
+splits = list(split_list or range(max(1, options["n_splits"])))
+scheduler = trial["scheduler"]
+
+
+class TrialStopped(Exception):
+    pass
+
+
+class RungCallback(Callback):
+    # writes the validation metric of each epoch, and stops the trial at a rung if it is not in the best trials
+    def __init__(self, split, network):
+        self.split = split
+        self.network = network
+        self.epoch = 0
+
+    def on_train_begin(self, parameters, **kwargs):
+        pass
+
+    def on_train_end(self, parameters, **kwargs):
+        pass
+
+    def on_epoch_end(self, parameters, **kwargs):
+        self.epoch += 1
+        value = kwargs["metrics_valid"][scheduler["metric"]]
+        with sqlite3.connect(trial["db_path"], timeout=60) as connection:
+            connection.execute(
+                "INSERT INTO epochs (trial_id, split, network, epoch, value, time) VALUES (?, ?, ?, ?, ?, ?)",
+                (trial["trial_id"], self.split, self.network, self.epoch, float(value), time.time()),
+            )
+            # the trials are compared on the first network of their first split
+            if self.split != splits[0] or self.network != 0 or self.epoch not in scheduler["rungs"]:
+                return
+            values = [v for (v,) in connection.execute(
+                "SELECT value FROM epochs WHERE split = ? AND network = 0 AND epoch = ?", (self.split, self.epoch)
+            )]
+        n_best = len(values) // scheduler["reduction_factor"]
+        ranked = sorted(values, reverse=not scheduler["lower_is_better"])
+        if n_best > 0 and (value > ranked[n_best - 1] if scheduler["lower_is_better"] else value < ranked[n_best - 1]):
+            raise TrialStopped()
+
+
+maps_manager = MapsManager(Path(trial["maps_dir"]), options, verbose=None)
+if scheduler["reduction_factor"] is not None:
+    n_networks = maps_manager.num_networks if maps_manager.multi_network else 1
+    with sqlite3.connect(trial["db_path"], timeout=60) as connection:
+        connection.execute("UPDATE trials SET n_networks = ? WHERE trial_id = ?", (n_networks, trial["trial_id"]))
+    train = maps_manager._train
+
+    def _train(train_loader, valid_loader, split, network=None, **kwargs):
+        # called for each split, and for each network of a split in the multi-network setting
+        init_callbacks = maps_manager._init_callbacks
+
+        def _init_callbacks():
+            init_callbacks()
+            maps_manager.callback_handler.add_callback(RungCallback(split, network or 0))
+
+        maps_manager._init_callbacks = _init_callbacks
+        try:
+            return train(train_loader, valid_loader, split, network, **kwargs)
+        finally:
+            maps_manager._init_callbacks = init_callbacks
+
+    maps_manager._train = _train
+try:
+    maps_manager.train(split_list=split_list, overwrite=True)
+except TrialStopped:
+    sys.exit(STOPPED)
+""".replace("STOPPED", str(STOPPED))
+
+LOWER_IS_BETTER = ["loss", "MAE", "MSE", "RMSE"]
+
+
+def open_trials_db(db_path):
+    """Opens the database of the trials of a search, and creates its tables if needed."""
+    connection = sqlite3.connect(db_path, timeout=60)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS trials ("
+        "trial_id INTEGER PRIMARY KEY, status TEXT, options TEXT, "
+        "start_time REAL, duration REAL, metrics TEXT, n_threads INTEGER, gpu INTEGER, n_networks INTEGER)"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS epochs "
+        "(trial_id INTEGER, split INTEGER, network INTEGER, epoch INTEGER, value REAL, time REAL)"
+    )
+    return connection
+
+
+def update_trial(db_path, trial_id, **values):
+    """Sets the values of some columns of a trial."""
+    assignments = ", ".join(f"{column} = ?" for column in values)
+    with closing(open_trials_db(db_path)) as connection, connection:
+        connection.execute(f"UPDATE trials SET {assignments} WHERE trial_id = ?", [*values.values(), trial_id])
+
+
+def sample_trial(space_options, trial_id, seed=0, budget=None, max_attempts=1000):
+    """
+    Samples the options of a trial as clinicadl random-search, with a seed depending on the trial.
+    :param budget: (dict) budgets of the architecture, see architecture_budget, or None.
+    :return: (dict) the training options.
+    """
+    random.seed(seed + trial_id)
+    for _ in range(max_attempts):
+        options = random_sampling(space_options)
+        options["architecture"] = "RandomArchitecture"
+        if budget is None or fits_budget(options, budget):
+            return options
+    raise ValueError(f"No architecture fitting the budget {budget} was sampled in {max_attempts} attempts.")
+
+
+def validation_metrics(maps_dir, mode, selection_metric="loss"):
+    """
+    Reads the validation metrics of a trained MAPS, averaged over its splits.
+    :return: (dict) the mean of each metric.
+    """
+    split_dfs = []
+    for path in sorted(
+        Path(maps_dir).glob(f"split-*/best-{selection_metric}/validation/validation_{mode}_level_metrics.tsv")
+    ):
+        split_df = pd.read_csv(path, sep="\t")
+        if "Metrics" in split_df.columns:
+            # metrics written with their confidence intervals
+            split_df = split_df.set_index("Metrics").loc[["Values"]]
+        split_dfs.append(split_df.apply(pd.to_numeric, errors="coerce"))
+    return pd.concat(split_dfs).mean().dropna().to_dict()
+
+
+def run_trial(db_path, search_dir, trial_id, options, n_threads, gpu_slots, scheduler):
+    """Trains a trial in a new process, then writes its status and validation metrics in the database."""
+    maps_dir = search_dir / f"trial-{trial_id}"
+    trial_path = search_dir / f"trial-{trial_id}.json"
+    with trial_path.open("w") as f:
+        json.dump(
+            {
+                "options": options,
+                "maps_dir": str(maps_dir),
+                "n_threads": n_threads,
+                "db_path": str(db_path),
+                "trial_id": trial_id,
+                "scheduler": scheduler,
+            },
+            f,
+        )
+    env = dict(os.environ, OMP_NUM_THREADS=str(n_threads), MKL_NUM_THREADS=str(n_threads))
+    gpu = gpu_slots.get()
+    if gpu is not None:
+        env["CUDA_VISIBLE_DEVICES"] = str(gpu)
+
+    # MAPS left by an interrupted run of the trial
+    shutil.rmtree(maps_dir, ignore_errors=True)
+    with closing(open_trials_db(db_path)) as connection, connection:
+        connection.execute("DELETE FROM epochs WHERE trial_id = ?", (trial_id,))
+    start_time = time.time()
+    update_trial(db_path, trial_id, status="running", start_time=start_time, n_threads=n_threads, gpu=gpu)
+    try:
+        with (search_dir / f"trial-{trial_id}.log").open("w") as log:
+            process = subprocess.run([sys.executable, "-c", TRIAL_SCRIPT, str(trial_path)], env=env, stdout=log, stderr=log)
+    finally:
+        gpu_slots.put(gpu)
+    if process.returncode == 0:
+        metrics = validation_metrics(maps_dir, options["mode"])
+        update_trial(db_path, trial_id, status="done", duration=time.time() - start_time, metrics=json.dumps(metrics))
+    elif process.returncode == STOPPED:
+        update_trial(db_path, trial_id, status="stopped", duration=time.time() - start_time)
+    elif -process.returncode in (signal.SIGINT, signal.SIGTERM):
+        # interrupted with the search, the trial is trained again when the search is resumed
+        update_trial(db_path, trial_id, status="pending")
+    else:
+        update_trial(db_path, trial_id, status="failed", duration=time.time() - start_time)
+    return trial_id
+
+
+def rung_scheduler(launch_directory):
+    """
+    Reads the settings of the early stopping of the trials in random_search.toml.
+    :return: (dict) the validation metric compared at the rungs, and the epochs of the rungs.
+    """
+    toml_options = toml.load(Path(launch_directory) / "random_search.toml")
+    search_options = toml_options["Random_Search"]
+    metric = search_options.get("asha_metric", "loss")
+    reduction_factor = search_options.get("asha_reduction_factor")
+    rungs = []
+    if reduction_factor is not None:
+        epochs = toml_options.get("Optimization", {}).get("epochs", 20)
+        rung = search_options.get("asha_min_epochs", 1)
+        while rung < epochs:
+            rungs.append(rung)
+            rung *= reduction_factor
+    return {
+        "metric": metric,
+        "lower_is_better": metric in LOWER_IS_BETTER,
+        "reduction_factor": reduction_factor,
+        "rungs": rungs,
+    }
+
+
+def parallel_random_search(
+    launch_directory, name, n_trials, n_workers=2, n_threads=None, gpus=None, seed=0, retry_failed=False
+):
+    """
+    Samples and trains the trials of a random search concurrently, and resumes an interrupted search.
+    :param launch_directory: (str) folder containing random_search.toml.
+    :param name: (str) name of the folder of the search, containing a MAPS per trial.
+    :param n_trials: (int) total number of trials of the search.
+    :param n_workers: (int) number of trials trained at the same time.
+    :param n_threads: (int) number of CPU threads of each trial, by default the CPUs are shared between the workers.
+    :param gpus: (list[int]) GPUs shared between the workers, or None to use the GPU setting of random_search.toml.
+    :param seed: (int) seed of the sampling of the trials.
+    :param retry_failed: (bool) if True the trials that failed in a previous run of the search are trained again.
+    :return: (DataFrame) the trials of the search.
+    """
+    launch_directory = Path(launch_directory)
+    search_dir = launch_directory / name
+    search_dir.mkdir(parents=True, exist_ok=True)
+    db_path = search_dir / "trials.sqlite"
+    n_threads = n_threads or max(1, os.cpu_count() // n_workers)
+    space_options = get_space_dict(launch_directory)
+    scheduler = rung_scheduler(launch_directory)
+    budget = architecture_budget(launch_directory, space_options)
+
+    with closing(open_trials_db(db_path)) as connection, connection:
+        # trials interrupted while running are trained again from scratch
+        connection.execute("UPDATE trials SET status = 'pending' WHERE status = 'running'")
+        if retry_failed:
+            connection.execute("UPDATE trials SET status = 'pending' WHERE status = 'failed'")
+        n_existing = connection.execute("SELECT COUNT(*) FROM trials").fetchone()[0]
+        for trial_id in range(n_existing, n_trials):
+            options = sample_trial(space_options, trial_id, seed, budget)
+            connection.execute(
+                "INSERT INTO trials (trial_id, status, options) VALUES (?, 'pending', ?)",
+                (trial_id, json.dumps(options, default=str)),
+            )
+        pending = connection.execute("SELECT trial_id, options FROM trials WHERE status = 'pending'").fetchall()
+
+    gpu_slots = Queue()
+    for worker in range(n_workers):
+        gpu_slots.put(gpus[worker % len(gpus)] if gpus else None)
+    with ThreadPoolExecutor(n_workers) as executor:
+        futures = [
+            executor.submit(
+                run_trial, db_path, search_dir, trial_id, json.loads(options), n_threads, gpu_slots, scheduler
+            )
+            for trial_id, options in pending
+        ]
+        try:
+            for future in futures:
+                future.result()
+        except KeyboardInterrupt:
+            # the trials not started are cancelled, the running ones are interrupted too
+            executor.shutdown(cancel_futures=True)
+            raise
+    return trials_df(search_dir)
+
+
+def trials_df(search_dir):
+    """
+    Reads the trials of a search.
+    :return: (DataFrame) the status, duration and validation metrics of each trial.
+    """
+    with closing(open_trials_db(Path(search_dir) / "trials.sqlite")) as connection:
+        df = pd.read_sql("SELECT * FROM trials", connection, index_col="trial_id")
+    metrics_df = pd.DataFrame([json.loads(m) if isinstance(m, str) else {} for m in df.metrics], index=df.index)
+    return df.drop(columns=["metrics"]).join(metrics_df)
+
+
+# %% [markdown]
+# The next cell runs 8 trials with 2 workers. If you interrupt it, run it
+# again to train the remaining trials:
+
+# %%
+search_df = parallel_random_search("random_search", "parallel_search", n_trials=8, n_workers=2)
+search_df
+
+# %% [markdown]
+# ## Stop the worst trials early
+#
+# Most trials are clearly worse than the others after a few epochs. With
+# [asynchronous successive halving](https://arxiv.org/abs/1810.05934) (ASHA),
+# a trial is compared to the other trials at some epochs, called rungs: at
+# each rung, it is stopped if its validation metric is not in the best
+# `1 / reduction_factor` of the values of all the trials that reached this
+# rung. The rungs are `min_epochs`, `min_epochs * reduction_factor`,
+# `min_epochs * reduction_factor ** 2`... The trials are not waiting for each
+# other: the first trials reaching a rung are compared to fewer trials.
+#
+# The scheduler is enabled by adding the following options to the
+# `Random_Search` section of `random_search.toml` (they are ignored by
+# `clinicadl random-search`):
+# - `asha_reduction_factor` (int) enables the scheduler and gives the
+# fraction of trials kept at each rung,
+# - `asha_min_epochs` (int) is the first rung (default 1),
+# - `asha_metric` (str) is the validation metric compared (default `loss`).
+#
+# The validation metric of each epoch is written in the database of the
+# search. With cross-validation, the trials are compared on their first
+# split, and a trial that is not stopped trains all its splits. Likewise, a
+# multi-network trial, which trains one network per location, is compared on
+# its first network.
+
+# %%
+asha_dict = generate_dict(gpu_avail, caps_dir, tsv_path, preprocessing_json)
+asha_dict["Random_Search"].update({"asha_reduction_factor": 3, "asha_min_epochs": 1, "asha_metric": "loss"})
+os.makedirs("random_search_asha", exist_ok=True)
+with open("random_search_asha/random_search.toml", "w") as toml_file:
+    toml.dump(asha_dict, toml_file)
+
+asha_df = parallel_random_search("random_search_asha", "parallel_search", n_trials=16, n_workers=2)
+asha_df.status.value_counts()
+
+
+# %% [markdown]
+# The next function estimates the resources saved by the scheduler: the time
+# per epoch of each stopped trial is used to estimate the time it would have
+# needed to train all its epochs, splits and networks, and the finished trials
+# count for the time they used. The resources are counted in GPU-hours
+# if the trials are trained on GPU, and in CPU-hours (time multiplied by the
+# number of threads of a trial) otherwise.
+
+# %%
+def scheduler_report(search_dir):
+    """
+    Compares the resources used by a search with an exhaustive training of all its trials.
+    :param search_dir: (str) folder of a search run with the scheduler.
+    :return: the (DataFrame) cost of each trial, and the (DataFrame) total cost for each type of resource.
+    """
+    trials = trials_df(search_dir)
+    with closing(open_trials_db(Path(search_dir) / "trials.sqlite")) as connection:
+        epochs_df = pd.read_sql(
+            "SELECT trial_id, COUNT(*) AS n_epochs FROM epochs GROUP BY trial_id", connection, index_col="trial_id"
+        )
+    if epochs_df.empty:
+        raise ValueError(
+            f"No epoch is written in the database of {search_dir}: the search must be run with the scheduler "
+            f"enabled by asha_reduction_factor."
+        )
+    trials = trials[trials.status.isin(["done", "stopped"])].join(epochs_df)
+    options = trials.options.map(json.loads)
+    gpu = options.map(lambda o: o["gpu"])
+
+    cost_df = trials[["status", "n_epochs"]].copy()
+    cost_df["full_epochs"] = options.map(
+        lambda o: o["epochs"] * (len(o["split"]) or max(1, o["n_splits"]))
+    ) * trials.n_networks.fillna(1)
+    cost_df["unit"] = np.where(gpu, "GPU-hours", "CPU-hours")
+    cost_df["hours"] = trials.duration / 3600 * np.where(gpu, 1, trials.n_threads)
+    # a finished trial may have used fewer epochs than full_epochs (patience), it did not save any time
+    cost_df["exhaustive_hours"] = np.where(
+        cost_df.status == "stopped", cost_df.hours / cost_df.n_epochs * cost_df.full_epochs, cost_df.hours
+    )
+    total_df = cost_df.groupby("unit")[["hours", "exhaustive_hours"]].sum()
+    total_df["saved_hours"] = total_df.exhaustive_hours - total_df.hours
+    total_df["saved_fraction"] = total_df.saved_hours / total_df.exhaustive_hours
+    return cost_df, total_df
+
+
+# %%
+cost_df, total_df = scheduler_report("random_search_asha/parallel_search")
+total_df
+
+# %% [markdown]
+# ## Reject oversized architectures before training
+#
+# The next cell sets budgets in the previous search space, and shows the cost
+# of the architectures sampled:
+
+# %%
+budget_dict = generate_dict(gpu_avail, caps_dir, tsv_path, preprocessing_json)
+budget_dict["Random_Search"].update({"max_memory_MiB": 4000, "max_gflops": 20})
+os.makedirs("random_search_budget", exist_ok=True)
+with open("random_search_budget/random_search.toml", "w") as toml_file:
+    toml.dump(budget_dict, toml_file)
+
+budget_df = parallel_random_search("random_search_budget", "parallel_search", n_trials=8, n_workers=2)
+space_options = get_space_dict(Path("random_search_budget"))
+budget = architecture_budget("random_search_budget", space_options)
+cost_df = pd.DataFrame(
+    [
+        architecture_cost(
+            o["convolutions_dict"], o["n_fcblocks"], budget["input_size"], o["network_normalization"], budget["output_size"]
+        )
+        for o in budget_df.options.map(json.loads)
+    ],
+    index=budget_df.index,
+)
+cost_df["training_memory_MiB"] = [training_memory(cost, budget["batch_size"]) for _, cost in cost_df.iterrows()]
+cost_df
+
 # %% [markdown]
 # ## Analysis of the random network
 
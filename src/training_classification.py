@@ -315,6 +315,14 @@ print('GPU is available: ', torch.cuda.is_available())
 # 2D-slice multi-CNN training
 !clinicadl train classification data_oasis/CAPS_example slice_classification_t1 data_oasis/split/4_fold/ data_oasis/maps_classification_2D_slice_multi --n_splits 4 --architecture resnet18 --multi_network
 
+# %% [markdown]
+# ```{tip}
+# With `--multi_network`, the networks of the different slice locations are
+# trained one after the other, and the images are read again for each of them.
+# The [speed up the training](./training_performance.ipynb) notebook shows how
+# to train all the networks at once while reading each image once per epoch.
+# ```
+
 # %% [markdown]
 # The `clinicadl train` command outputs a MAPS structure in which there are only
 # two data groups: train and validation. 
@@ -425,6 +433,14 @@ print('GPU is available: ', torch.cuda.is_available())
 # %%
 !clinicadl predict data_oasis/maps_classification_2D_slice_multi 'test-Oasis' --participants_tsv ./data_oasis/split/test_baseline.tsv --caps_directory data_oasis/CAPS_example
 
+# %% [markdown]
+# ```{tip}
+# For a multi-network MAPS, the networks are evaluated one after the other and
+# the images are read again for each of them. The
+# [speed up the inference](./inference_performance.ipynb) notebook shows how to
+# evaluate all the networks and compute the soft-voting in a single pass.
+# ```
+
 # %% [markdown]
 # Results are stored in the MAPS of path `model_path`, according to the
 # following file system:
@@ -0,0 +1,1100 @@
+# -*- coding: utf-8 -*-
+# ---
+# jupyter:
+#   jupytext:
+#     text_representation:
+#       extension: .py
+#       format_name: percent
+#       format_version: '1.5'
+#       jupytext_version: 1.13.3
+#   kernelspec:
+#     display_name: Python 3
+#     name: python3
+# ---
+
+# %%
+# Uncomment this cell if running in Google Colab
+# !pip install clinicadl==1.6.1
+# !curl -k https://raw.githubusercontent.com/aramis-lab/clinicadl_handbook/main/notebooks/handbook_utils.py -o handbook_utils.py
+
+# %% [markdown]
+# # Speed up the training
+#
+# The previous notebooks trained networks with the default options of
+# `clinicadl train`. These defaults are a good starting point, but some
+# frameworks are much more expensive than others: a multi-network trained on
+# 3D patches trains as many CNNs as there are patch locations, and a CNN
+# trained on full 3D images needs a lot of memory for each sample.
+#
+# This notebook gathers recipes, built on top of the ClinicaDL API, to reduce
+# the time and the memory needed to train these networks.
+#
+# ```{warning}
+# The recipes of this notebook are meant to be run on the full dataset used in
+# the [classification notebook](./training_classification.ipynb). On the
+# example CAPS, they only show how things work.
+# ```
+
+# %%
+import torch
+
+# Check if a GPU is available
+print('GPU is available: ', torch.cuda.is_available())
+
+# %% [markdown]
+# If you did not run the [classification notebook](./training_classification.ipynb),
+# uncomment the next cell to download the CAPS with the extracted slices and
+# the splits used in this notebook.
+
+# %%
+# !curl -k https://aramislab.paris.inria.fr/clinicadl/files/handbook_2023/data_oasis/CAPS_example_prepared.tar.gz -o oasisCaps.tar.gz
+# !tar xf oasisCaps.tar.gz
+# !curl -k https://aramislab.paris.inria.fr/clinicadl/files/handbook_2023/data_oasis/split.tar.gz -o training_split.tar.gz
+# !tar xf training_split.tar.gz
+
+# %% [markdown]
+# ## Train all the networks of a multi-network at once
+#
+# With the `--multi_network` flag, `clinicadl train` trains one network per
+# slice, patch or region location. These networks are trained one after the
+# other: for each location, the whole training set is read again, so a
+# multi-network on 36 patches costs 36 times the training of a single network.
+#
+# However, the networks of a multi-network are independent: they do not share
+# any weight and their losses are only combined at the end, by soft-voting.
+# They can then be gathered in a single module whose loss is the sum of the
+# losses of each network. As the gradient of the sum with respect to the
+# weights of one network is the gradient of its own loss, one optimization step
+# on this module performs one step for each network. This has two advantages:
+# - each image is read once per epoch and all its locations are extracted from
+# memory, instead of being read once per location,
+# - all the networks are trained during the same epochs, and the networks can
+# be distributed on several GPUs to run concurrently.
+#
+# The first step is a dataset in which one sample contains all the locations
+# of one image. `AllLocationsDataset` reads each image tensor once and extracts
+# its slices or patches with `extract_all_locations`. These helpers, also used
+# by other notebooks, are defined in `handbook_utils.py`, next to the
+# notebooks.
+
+# %%
+from handbook_utils import AllLocationsDataset
+
+
+# %% [markdown]
+# The image dataset is the `CapsDataset` used by ClinicaDL for the `image`
+# mode, without any transformation: as in ClinicaDL, the normalization and the
+# data augmentation are applied on each location after its extraction.
+#
+# The networks are then gathered in a `MultiNetwork` module. Its forward pass
+# gives the locations `i` of the batch to the network `i`, and returns one
+# output per network. If several devices are given, the networks are
+# distributed on them: as CUDA operations are asynchronous, the networks on
+# different GPUs then run concurrently.
+
+# %%
+from torch import nn
+
+
+class MultiNetwork(nn.Module):
+    """Gathers the independent networks of a multi-network framework."""
+    def __init__(self, networks, devices=("cpu",)):
+        super().__init__()
+        self.devices = [devices[i % len(devices)] for i in range(len(networks))]
+        self.networks = nn.ModuleList(
+            [network.to(device) for network, device in zip(networks, self.devices)]
+        )
+
+    def forward(self, x):
+        """
+        :param x: (Tensor) batch of size (batch_size, n_networks, C, ...).
+        :return: (list[Tensor]) the outputs of each network.
+        """
+        return [
+            network(x[:, i].to(device, non_blocking=True))
+            for i, (network, device) in enumerate(zip(self.networks, self.devices))
+        ]
+
+    def compute_losses(self, outputs, labels, criterion):
+        return torch.stack(
+            [criterion(output, labels.to(output.device)).to(self.devices[0]) for output in outputs]
+        )
+
+
+# %% [markdown]
+# The training loop is similar to the one of `clinicadl train`, except that
+# the loss of each network is followed separately on the validation set. Each
+# network keeps its own best epoch, and the selected weights are written with
+# the same names as in a MAPS trained with `--multi_network`
+# (`split-<i>/best-loss/network-<j>_model.pth.tar`). The output directory is
+# created as a MAPS by the `MapsManager` of ClinicaDL, which writes `maps.json`,
+# `environment.txt` and the data groups. As in `clinicadl train`, the
+# validation set is predicted at the end, as soft-voting weighs the networks
+# with these predictions: `clinicadl predict` can then be used on the MAPS.
+
+# %%
+from pathlib import Path
+
+import pandas as pd
+from torch.utils.data import DataLoader
+
+from clinicadl.utils.caps_dataset.data import CapsDatasetImage, get_transforms
+from clinicadl.utils.maps_manager import MapsManager
+from clinicadl.utils.preprocessing import read_preprocessing
+from clinicadl.utils.split_manager import KFoldSplit
+from clinicadl.utils.task_manager.classification import ClassificationManager
+import clinicadl.utils.network as network_package
+
+
+def evaluate_multi_network(model, loader, criterion):
+    """Computes the mean validation loss of each network of the multi-network."""
+    model.eval()
+    loader.dataset.eval()
+    total_losses = torch.zeros(len(model.networks))
+    with torch.no_grad():
+        for data in loader:
+            outputs = model(data["image"])
+            losses = model.compute_losses(outputs, data["label"], criterion)
+            total_losses += losses.cpu() * len(data["label"])
+    return total_losses / len(loader.dataset)
+
+
+def train_multi_network(
+    caps_directory,
+    preprocessing_json,
+    tsv_path,
+    output_dir,
+    architecture="resnet18",
+    split=0,
+    n_splits=4,
+    diagnoses=("AD", "CN"),
+    label="diagnosis",
+    epochs=20,
+    batch_size=8,
+    learning_rate=1e-4,
+    n_proc=2,
+    devices=None,
+):
+    """
+    Trains all the networks of a multi-network in a single loop.
+    :param caps_directory: (Path) CAPS directory in which prepare-data was run.
+    :param preprocessing_json: (str) name of the JSON file written by prepare-data.
+    :param tsv_path: (Path) output directory of clinicadl tsvtools kfold.
+    :param output_dir: (Path) path of the MAPS created, which must not exist or be empty.
+    :param devices: (list[str]) devices on which the networks are distributed.
+    :return: (DataFrame) the training and validation losses of each network at each epoch.
+    """
+    caps_directory = Path(caps_directory)
+    output_dir = Path(output_dir)
+    if devices is None:
+        devices = [f"cuda:{i}" for i in range(torch.cuda.device_count())] or ["cpu"]
+
+    preprocessing_dict = read_preprocessing(caps_directory / "tensor_extraction" / preprocessing_json)
+    # maps.json, environment.txt and data groups of clinicadl train --multi_network
+    maps_manager = MapsManager(
+        output_dir,
+        {
+            "caps_directory": caps_directory,
+            "tsv_path": Path(tsv_path),
+            "preprocessing_dict": preprocessing_dict,
+            "mode": preprocessing_dict["mode"],
+            "network_task": "classification",
+            "architecture": architecture,
+            "multi_network": True,
+            "n_splits": n_splits,
+            "split": [split],
+            "diagnoses": list(diagnoses),
+            "label": label,
+            "baseline": True,
+            "epochs": epochs,
+            "batch_size": batch_size,
+            "learning_rate": learning_rate,
+            "n_proc": n_proc,
+            "gpu": devices[0] != "cpu",
+        },
+        verbose=None,
+    )
+    split_df_dict = KFoldSplit(caps_directory, Path(tsv_path), list(diagnoses), n_splits, baseline=True)[split]
+    label_code = ClassificationManager.generate_label_code(split_df_dict["train"], label)
+    train_transforms, all_transforms = get_transforms()
+
+    loaders = dict()
+    for data_group, df in split_df_dict.items():
+        dataset = CapsDatasetImage(
+            caps_directory,
+            df,
+            preprocessing_dict,
+            label=label,
+            label_code=label_code,
+        )
+        loaders[data_group] = DataLoader(
+            AllLocationsDataset(dataset, preprocessing_dict, all_transforms, train_transforms),
+            batch_size=batch_size,
+            shuffle=(data_group == "train"),
+            num_workers=n_proc,
+            pin_memory=devices[0] != "cpu",
+        )
+
+    # One network per location, built as in clinicadl train
+    example = loaders["train"].dataset[0]["image"]
+    model_class = getattr(network_package, architecture)
+    networks = [
+        model_class(input_size=list(example.shape[1:]), gpu=False, output_size=len(label_code))
+        for _ in range(example.shape[0])
+    ]
+    model = MultiNetwork(networks, devices=devices)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+
+    best_losses = torch.full((len(networks),), float("inf"))
+    best_dir = output_dir / f"split-{split}" / "best-loss"
+    best_dir.mkdir(parents=True, exist_ok=True)
+    logs = []
+    for epoch in range(epochs):
+        model.train()
+        loaders["train"].dataset.train()
+        for data in loaders["train"]:
+            optimizer.zero_grad(set_to_none=True)
+            outputs = model(data["image"])
+            losses = model.compute_losses(outputs, data["label"], criterion)
+            losses.sum().backward()
+            optimizer.step()
+
+        train_losses = evaluate_multi_network(model, loaders["train"], criterion)
+        valid_losses = evaluate_multi_network(model, loaders["validation"], criterion)
+        for network_idx, network in enumerate(model.networks):
+            logs.append([epoch, network_idx, train_losses[network_idx].item(), valid_losses[network_idx].item()])
+            if valid_losses[network_idx] < best_losses[network_idx]:
+                best_losses[network_idx] = valid_losses[network_idx]
+                torch.save(
+                    {"model": network.state_dict(), "epoch": epoch, "name": architecture},
+                    best_dir / f"network-{network_idx}_model.pth.tar",
+                )
+
+    training_df = pd.DataFrame(logs, columns=["epoch", "network", "loss_train", "loss_valid"])
+    training_df.to_csv(output_dir / f"split-{split}" / "training.tsv", sep="\t", index=False)
+    # as clinicadl train, predict the validation set: soft-voting weighs the networks with these predictions
+    maps_manager.predict(
+        "validation",
+        split_list=[split],
+        selection_metrics=["loss"],
+        gpu=devices[0] != "cpu",
+        n_proc=n_proc,
+        batch_size=batch_size,
+    )
+    return training_df
+
+
+# %% [markdown]
+# The next cell trains the 2D slice-level multi-CNN of the
+# [classification notebook](./training_classification.ipynb) on the first
+# split. Compared to `clinicadl train classification ... --multi_network`,
+# each image is read once per epoch instead of once per slice and per epoch.
+
+# %%
+training_df = train_multi_network(
+    "data_oasis/CAPS_example",
+    "slice_classification_t1",
+    "data_oasis/split/4_fold",
+    "data_oasis/multi_network_grouped",
+    architecture="resnet18",
+    epochs=3,
+)
+training_df.groupby("network").loss_valid.min().head()
+
+# %% [markdown]
+# ```{note}
+# All the locations of a batch are kept in memory at the same time: with
+# `resnet18` on slices, a batch contains `batch_size` times the number of
+# slices. If the memory of your GPU is too small, reduce the batch size or
+# distribute the networks on several GPUs with the `devices` argument.
+# ```
+#
+# The same function trains a patch-level multi-CNN (as the `Conv4_FC3`
+# multi-CNN of the [reconstruction notebook](./training_reconstruction.ipynb))
+# if the JSON file given was written by `clinicadl prepare-data patch`.
+
+# %% [markdown]
+# ## Mixed precision and channels-last memory format
+#
+# By default, the networks are trained in single precision (`float32`). With
+# the `--amp` flag, `clinicadl train` uses half precision (`float16`) for the
+# operations that allow it, but only on GPU. Recent CPUs also provide fast
+# operations in `bfloat16`, a half-precision format with the same range as
+# `float32`: it does not need the loss scaling required by `float16`.
+#
+# The convolutions of 3D CNNs can also be faster when the channels are the
+# last dimension in memory (`channels_last_3d` format), in particular in half
+# precision. The shape of the tensors does not change, only the order in which
+# their values are stored.
+#
+# The following functions train and evaluate a ClinicaDL network (a CNN such
+# as `Conv5_FC3` or an autoencoder such as `AE_Conv5_FC3`) with these two
+# options:
+# - `amp` runs the forward pass with `float16` on GPU and `bfloat16` on CPU.
+# The loss and the metrics of the `MetricModule` are always computed in
+# `float32`, and the loss is scaled on GPU as in `clinicadl train --amp`.
+# - `channels_last` converts the network and the inputs to the channels-last
+# memory format.
+
+# %%
+from time import perf_counter
+
+import psutil
+
+from clinicadl.utils.network.sub_network import AutoEncoder
+from handbook_utils import PeakMemory, autocast_context
+
+
+def channels_last_format(input_size):
+    """Channels-last memory format corresponding to an input of size (C, [D,] H, W)."""
+    return torch.channels_last_3d if len(input_size) == 4 else torch.channels_last
+
+
+def forward_step(model, data, criterion, amp=False, memory_format=torch.preserve_format):
+    """
+    Computes the outputs of a ClinicaDL network and its loss.
+    :param model: (Network) a CNN or an AutoEncoder.
+    :param data: (dict) batch given by a CapsDataset.
+    :param memory_format: (torch.memory_format) memory format of the inputs.
+    :return: (Tensor, Tensor) outputs and loss, both in float32.
+    """
+    images = data["image"].to(model.device, memory_format=memory_format, non_blocking=True)
+    with autocast_context(model.device, amp):
+        outputs = model.predict(images)
+    # The loss is computed in float32, out of the autocast region
+    outputs = outputs.float()
+    if isinstance(model, AutoEncoder):
+        targets = images
+    else:
+        targets = data["label"].to(model.device)
+    return outputs, criterion(outputs, targets)
+
+
+def evaluate_network(model, task_manager, loader, criterion, amp=False, memory_format=torch.preserve_format):
+    """
+    Computes the predictions and the metrics of a network, as clinicadl predict does.
+    :param task_manager: (TaskManager) task manager of the task learnt by the network.
+    :return: (DataFrame, dict) predictions and metrics, including the loss.
+    """
+    model.eval()
+    loader.dataset.eval()
+    rows = []
+    total_loss = 0
+    with torch.no_grad():
+        for data in loader:
+            outputs, loss = forward_step(model, data, criterion, amp, memory_format)
+            total_loss += loss.item() * len(outputs)
+            outputs = outputs.cpu()
+            for idx in range(len(outputs)):
+                rows += task_manager.generate_test_row(idx, data, outputs)
+    results_df = pd.DataFrame(rows, columns=task_manager.columns)
+    metrics = task_manager.compute_metrics(results_df, report_ci=False)
+    metrics["loss"] = total_loss / len(loader.dataset)
+    return results_df, metrics
+
+
+def train_network(
+    model,
+    task_manager,
+    loaders,
+    criterion,
+    epochs=20,
+    learning_rate=1e-4,
+    amp=False,
+    channels_last=False,
+    accumulation_steps=1,
+):
+    """
+    Trains a ClinicaDL network and evaluates it on the validation set at each epoch.
+    :param loaders: (dict[str, DataLoader]) loaders of the train and validation sets.
+    :param amp: (bool) if True the forward pass is run in float16 on GPU and bfloat16 on CPU.
+    :param channels_last: (bool) if True the network and the inputs use the channels-last memory format.
+    :param accumulation_steps: (int) number of batches whose gradients are accumulated before each update.
+    :return: (DataFrame) training throughput, peak memory and validation metrics at each epoch.
+    """
+    memory_format = torch.preserve_format
+    if channels_last:
+        memory_format = channels_last_format(loaders["train"].dataset[0]["image"].shape)
+        model.to(memory_format=memory_format)
+    on_gpu = torch.device(model.device).type == "cuda"
+    scaler = torch.cuda.amp.GradScaler(enabled=amp and on_gpu)
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+
+    n_batches = len(loaders["train"])
+    # the last group of batches is smaller if n_batches is not a multiple of accumulation_steps
+    last_group_size = n_batches % accumulation_steps or accumulation_steps
+    logs = []
+    for epoch in range(epochs):
+        model.train()
+        loaders["train"].dataset.train()
+        start = perf_counter()
+        with PeakMemory(model.device) as peak_memory:
+            optimizer.zero_grad(set_to_none=True)
+            for step, data in enumerate(loaders["train"], start=1):
+                _, loss = forward_step(model, data, criterion, amp, memory_format)
+                group_size = last_group_size if step > n_batches - last_group_size else accumulation_steps
+                scaler.scale(loss / group_size).backward()
+                if step % accumulation_steps == 0 or step == n_batches:
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
+            if on_gpu:
+                torch.cuda.synchronize(model.device)
+        images_per_second = len(loaders["train"].dataset) / (perf_counter() - start)
+
+        _, metrics = evaluate_network(model, task_manager, loaders["validation"], criterion, amp, memory_format)
+        logs.append({
+            "epoch": epoch,
+            "images_per_second": images_per_second,
+            "peak_memory_MiB": peak_memory.peak,
+            **metrics,
+        })
+    return pd.DataFrame(logs)
+
+
+# %% [markdown]
+# The benchmark below uses the synthetic dataset of the
+# [generate notebook](./generate.ipynb), in which the difference between the
+# classes is trivial: the accuracy obtained in half precision should be the
+# same as in single precision. If you did not run this notebook, uncomment the
+# next cell to generate the dataset and its splits.
+
+# %%
+# !clinicadl generate trivial data_oasis/CAPS_example data/synthetic --n_subjects 4 --preprocessing t1-linear
+# !mkdir data/fake_bids
+# !clinicadl tsvtools get-labels data/fake_bids data --missing_mods data/synthetic/missing_mods --merged_tsv data/synthetic/data.tsv --modality synthetic
+# !clinicadl tsvtools split data/labels.tsv --n_test 0.25 --subset_name test
+# !clinicadl tsvtools kfold data/split/train.tsv --n_splits 3
+# !clinicadl prepare-data image data/synthetic t1-linear --extract_json extract_T1linear_image
+
+# %%
+def get_image_loaders(
+    caps_directory,
+    preprocessing_json,
+    tsv_path,
+    split=0,
+    n_splits=3,
+    diagnoses=("AD", "CN"),
+    label="diagnosis",
+    batch_size=2,
+    n_proc=2,
+):
+    """
+    Builds the loaders of the train and validation sets of a split in image mode.
+    :return: (dict[str, DataLoader], dict) the loaders and the label code.
+    """
+    caps_directory = Path(caps_directory)
+    preprocessing_dict = read_preprocessing(caps_directory / "tensor_extraction" / preprocessing_json)
+    split_df_dict = KFoldSplit(caps_directory, Path(tsv_path), list(diagnoses), n_splits, baseline=True)[split]
+    label_code = ClassificationManager.generate_label_code(split_df_dict["train"], label)
+    train_transforms, all_transforms = get_transforms()
+
+    loaders = dict()
+    for data_group, df in split_df_dict.items():
+        dataset = CapsDatasetImage(
+            caps_directory,
+            df,
+            preprocessing_dict,
+            train_transformations=train_transforms,
+            all_transformations=all_transforms,
+            label=label,
+            label_code=label_code,
+        )
+        loaders[data_group] = DataLoader(
+            dataset,
+            batch_size=batch_size,
+            shuffle=(data_group == "train"),
+            num_workers=n_proc,
+            pin_memory=torch.cuda.is_available(),
+        )
+    return loaders, label_code
+
+
+# %% [markdown]
+# The same CNN (`Conv5_FC3`) and autoencoder (`AE_Conv5_FC3`) are trained
+# from the same initialization with each configuration.
+
+# %%
+from clinicadl.utils.network import AE_Conv5_FC3, Conv5_FC3
+from clinicadl.utils.task_manager.reconstruction import ReconstructionManager
+
+loaders, label_code = get_image_loaders("data/synthetic", "extract_T1linear_image", "data/split/3_fold")
+input_size = list(loaders["train"].dataset[0]["image"].shape)
+gpu = torch.cuda.is_available()
+
+benchmarks = []
+for architecture in ["Conv5_FC3", "AE_Conv5_FC3"]:
+    for amp, channels_last in [(False, False), (True, False), (True, True)]:
+        torch.manual_seed(42)
+        if architecture == "Conv5_FC3":
+            model = Conv5_FC3(input_size=input_size, gpu=gpu, output_size=len(label_code))
+            task_manager = ClassificationManager("image", n_classes=len(label_code))
+            criterion, metric = nn.CrossEntropyLoss(), "BA"
+        else:
+            model = AE_Conv5_FC3(input_size=input_size, gpu=gpu)
+            task_manager = ReconstructionManager("image")
+            criterion, metric = nn.MSELoss(), "SSIM"
+        logs = train_network(
+            model, task_manager, loaders, criterion, epochs=5, amp=amp, channels_last=channels_last
+        )
+        benchmarks.append({
+            "architecture": architecture,
+            "amp": amp,
+            "channels_last": channels_last,
+            # the first epoch includes the warm-up of the kernels
+            "images_per_second": logs.images_per_second[1:].mean(),
+            "loss_valid": logs.loss.iloc[-1],
+            "metric": metric,
+            "metric_valid": logs[metric].iloc[-1],
+        })
+pd.DataFrame(benchmarks)
+
+# %% [markdown]
+# ```{note}
+# `bfloat16` is only faster on CPUs which natively support it (for example
+# Intel CPUs with AVX512-BF16 or AMX instructions). On other CPUs, the
+# conversions make the training slower: keep the default `float32` in this case.
+# ```
+#
+# The same `amp` option can be used when evaluating a trained network with
+# `evaluate_network`, or with the multi-network prediction of the
+# [speed up the inference](./inference_performance.ipynb) notebook.
+
+# %% [markdown]
+# ## Gradient accumulation
+#
+# In `image` mode, a batch of 3D images needs a lot of memory: the
+# activations of all the convolution layers are kept in memory for the
+# backward pass, and their size is proportional to the batch size. The batch
+# size is then often limited by the memory, and is much smaller than the batch
+# size used in the literature.
+#
+# With gradient accumulation, a batch is split in several micro-batches. The
+# gradients of the micro-batches are summed, and the weights are only updated
+# once all the micro-batches of the batch were processed. The memory needed
+# only depends on the size of the micro-batches, while the effective batch
+# size is `batch_size * accumulation_steps`. `clinicadl train` provides this
+# option with `--accumulation_steps`, and `train_network` above with its
+# `accumulation_steps` argument. The loss of each micro-batch is divided by
+# the number of micro-batches of its group, including the last group of an
+# epoch, which is smaller if the number of batches is not a multiple of
+# `accumulation_steps`.
+#
+# The next cell trains `Conv5_FC3` with the same effective batch size of 8
+# images split in micro-batches of different sizes, and reports the peak
+# memory used during the training.
+
+# %%
+benchmarks = []
+for batch_size, accumulation_steps in [(8, 1), (4, 2), (2, 4), (1, 8)]:
+    loaders, label_code = get_image_loaders(
+        "data/synthetic", "extract_T1linear_image", "data/split/3_fold", batch_size=batch_size
+    )
+    torch.manual_seed(42)
+    model = Conv5_FC3(input_size=input_size, gpu=gpu, output_size=len(label_code))
+    task_manager = ClassificationManager("image", n_classes=len(label_code))
+    logs = train_network(
+        model, task_manager, loaders, nn.CrossEntropyLoss(), epochs=3, accumulation_steps=accumulation_steps
+    )
+    benchmarks.append({
+        "batch_size": batch_size,
+        "accumulation_steps": accumulation_steps,
+        "peak_memory_MiB": logs.peak_memory_MiB.max(),
+        "images_per_second": logs.images_per_second[1:].mean(),
+        "loss_valid": logs.loss.iloc[-1],
+    })
+pd.DataFrame(benchmarks)
+
+# %% [markdown]
+# ```{note}
+# The batch normalization layers compute their statistics on each
+# micro-batch, so the training is not strictly equivalent to the training
+# with large batches. With micro-batches of 1 or 2 images, these statistics
+# are noisy: the `amp` option of the previous section can also be used to
+# fit larger micro-batches in memory.
+# ```
+
+# %% [markdown]
+# ## Activation checkpointing
+#
+# During the forward pass, the outputs of all the layers are kept in memory to
+# compute the gradients in the backward pass. For 3D images, these activations
+# use much more memory than the weights of the network: in `Conv5_FC3`, the
+# output of the first convolution alone has 8 channels of the size of the
+# input image.
+#
+# With activation checkpointing, only the input of each convolutional block
+# (convolution, normalization, activation and pooling) is kept in memory. The
+# other activations of the block are computed again during the backward pass.
+# The memory used by the activations is then divided by the number of layers
+# in a block, at the cost of one more forward pass of the convolutional layers.
+#
+# The following container replaces the `convolutions` of a `CNN`, or the
+# `encoder` and `decoder` of an `AutoEncoder`. It contains the same layers as
+# the original container, so the state dict of the network does not change:
+# the weights can be loaded or saved as in a MAPS.
+
+# %%
+from torch.nn.modules.conv import _ConvNd
+from torch.utils.checkpoint import checkpoint
+
+from clinicadl.utils.network.network_utils import (
+    CropMaxUnpool2d,
+    CropMaxUnpool3d,
+    PadMaxPool2d,
+    PadMaxPool3d,
+)
+from clinicadl.utils.network.sub_network import CNN
+
+
+def uses_indices(layer):
+    """True if the layer returns or takes the indices of a max pooling (in autoencoders)."""
+    if isinstance(layer, (PadMaxPool2d, PadMaxPool3d, nn.MaxPool2d, nn.MaxPool3d)):
+        return layer.return_indices
+    return isinstance(layer, (CropMaxUnpool2d, CropMaxUnpool3d, nn.MaxUnpool2d, nn.MaxUnpool3d))
+
+
+class CheckpointedSegment:
+    """Runs a list of layers with activation checkpointing during the training."""
+    def __init__(self, layers):
+        self.layers = layers
+        self.n_calls = 0
+
+    def run(self, x):
+        # The second call is the recomputation of the backward pass: the running
+        # statistics of the normalization layers must not be updated twice.
+        # The recomputation may be interrupted once the activations needed are
+        # computed, so the layers are restored in a finally clause.
+        saved_states = {}
+        if self.n_calls > 0:
+            saved_states = {
+                layer: (layer.momentum, layer.num_batches_tracked.clone())
+                for layer in self.layers
+                if isinstance(layer, nn.modules.batchnorm._BatchNorm) and layer.track_running_stats
+            }
+        self.n_calls += 1
+        try:
+            for layer in saved_states:
+                layer.momentum = 0.0
+            for layer in self.layers:
+                x = layer(x)
+        finally:
+            for layer, (momentum, num_batches_tracked) in saved_states.items():
+                layer.momentum = momentum
+                layer.num_batches_tracked.copy_(num_batches_tracked)
+        return x
+
+    def __call__(self, x):
+        if self.layers[0].training and torch.is_grad_enabled():
+            return checkpoint(self.run, x, use_reentrant=False)
+        return self.run(x)
+
+
+class CheckpointedSequential(nn.Sequential):
+    """
+    Sequential container in which each convolutional block is checkpointed.
+    A block starts at each convolution. The layers using the indices of a max
+    pooling are run outside the blocks, as they are called one by one in the
+    forward pass of AutoEncoder.
+    """
+    def segments(self):
+        segments, current = [], []
+        for layer in super().__iter__():
+            if uses_indices(layer) or (isinstance(layer, _ConvNd) and current):
+                if current:
+                    segments.append(CheckpointedSegment(current))
+                current = []
+            if uses_indices(layer):
+                segments.append(layer)
+            else:
+                current.append(layer)
+        if current:
+            segments.append(CheckpointedSegment(current))
+        return segments
+
+    def __iter__(self):
+        return iter(self.segments())
+
+    def forward(self, x):
+        for segment in self:
+            x = segment(x)
+        return x
+
+
+def enable_activation_checkpointing(model):
+    """
+    Applies activation checkpointing to each convolutional block of a network.
+    :param model: (Network) a CNN or an AutoEncoder.
+    :return: (Network) the same network, with the same state dict.
+    """
+    if isinstance(model, CNN):
+        model.convolutions = CheckpointedSequential(*model.convolutions)
+    elif isinstance(model, AutoEncoder):
+        model.encoder = CheckpointedSequential(*model.encoder)
+        model.decoder = CheckpointedSequential(*model.decoder)
+    else:
+        raise NotImplementedError(
+            f"Activation checkpointing is not implemented for {type(model).__name__}."
+        )
+    return model
+
+
+# %% [markdown]
+# The next cell compares the peak memory and the throughput of `Conv5_FC3`
+# trained with and without checkpointing on the synthetic images, of size
+# 169x208x179, with a batch of 2 images.
+
+# %%
+loaders, label_code = get_image_loaders(
+    "data/synthetic", "extract_T1linear_image", "data/split/3_fold", batch_size=2
+)
+benchmarks = []
+for activation_checkpointing in [False, True]:
+    torch.manual_seed(42)
+    model = Conv5_FC3(input_size=input_size, gpu=gpu, output_size=len(label_code))
+    if activation_checkpointing:
+        enable_activation_checkpointing(model)
+    task_manager = ClassificationManager("image", n_classes=len(label_code))
+    logs = train_network(model, task_manager, loaders, nn.CrossEntropyLoss(), epochs=3)
+    benchmarks.append({
+        "activation_checkpointing": activation_checkpointing,
+        "peak_memory_MiB": logs.peak_memory_MiB.max(),
+        "images_per_second": logs.images_per_second[1:].mean(),
+        "loss_valid": logs.loss.iloc[-1],
+    })
+pd.DataFrame(benchmarks)
+
+# %% [markdown]
+# ```{note}
+# The peak memory cannot be lower than the memory needed to recompute and
+# backpropagate through the first block, which works at the full resolution of
+# the image. In `Conv5_FC3`, this block holds most of the activations, so the
+# memory saved is smaller than the number of layers suggests: on CPU with the
+# synthetic images, the peak memory goes from 2.56 to 2.25 GiB (about 12%),
+# while the throughput drops by about 40%.
+# Checkpointing is more useful for deeper networks, and can be combined with
+# the previous options: mixed precision halves the size of all the
+# activations, including the ones of the first block.
+# ```
+
+# %% [markdown]
+# ## Choose the batch size and the number of workers
+#
+# The best values of `--batch_size` and `--n_proc` depend on the mode, on the
+# network and on the machine: a batch of slices is much smaller than a batch of
+# full 3D images, and a batch size that is too large stops the training with
+# an out-of-memory error.
+#
+# The following functions probe these values on a small random sample of the
+# data. For each setting, a few steps are run (training steps with an `Adam`
+# optimizer, or prediction steps without gradients), and the throughput and
+# the peak memory are measured with the `PeakMemory` context of the previous
+# sections. The first batch, which includes the start of the workers, is not
+# timed.
+#
+# The batch size is increased until the memory used would exceed a fraction of
+# the memory available, or until an out-of-memory error occurs. The fastest
+# batch size is kept, then the number of workers is chosen for this batch
+# size: the smallest number of workers reaching 95% of the best throughput is
+# kept, as each worker needs its own memory.
+
+# %%
+import os
+
+from torch.utils.data import RandomSampler
+
+
+def probe_settings(model, dataset, criterion, batch_size, n_proc, train=True, n_batches=5, amp=False):
+    """
+    Measures the throughput and the peak memory of a few steps on random samples of dataset.
+    The weights of the model are modified when train is True.
+    :param train: (bool) if True training steps are run, else prediction steps.
+    :param n_batches: (int) number of batches run, including a warm-up batch.
+    :return: (dict) samples_per_second and peak_memory_MiB of the setting.
+    """
+    sampler = RandomSampler(dataset, replacement=True, num_samples=batch_size * n_batches)
+    loader = DataLoader(
+        dataset, batch_size=batch_size, sampler=sampler, num_workers=n_proc, pin_memory=torch.cuda.is_available()
+    )
+    on_gpu = torch.device(model.device).type == "cuda"
+    optimizer = torch.optim.Adam(model.parameters())
+    model.train(train)
+    dataset.train() if train else dataset.eval()
+
+    with PeakMemory(model.device) as peak_memory:
+        for step, data in enumerate(loader):
+            if step == 1:
+                if on_gpu:
+                    torch.cuda.synchronize(model.device)
+                start = perf_counter()
+            with torch.set_grad_enabled(train), autocast_context(model.device, amp):
+                _, loss_dict = model.compute_outputs_and_loss(data, criterion)
+            if train:
+                optimizer.zero_grad(set_to_none=True)
+                loss_dict["loss"].float().backward()
+                optimizer.step()
+        if on_gpu:
+            torch.cuda.synchronize(model.device)
+    return {
+        "samples_per_second": batch_size * (n_batches - 1) / (perf_counter() - start),
+        "peak_memory_MiB": peak_memory.peak,
+    }
+
+
+def available_memory(device):
+    """Memory available on the device, in MiB."""
+    if torch.device(device).type == "cuda":
+        return torch.cuda.mem_get_info(torch.device(device))[0] / 2 ** 20
+    return psutil.virtual_memory().available / 2 ** 20
+
+
+def autotune(
+    model,
+    dataset,
+    criterion,
+    train=True,
+    batch_sizes=(2, 4, 8, 16, 32, 64, 128),
+    n_procs=None,
+    memory_fraction=0.8,
+    n_batches=5,
+    amp=False,
+):
+    """
+    Finds the fastest batch size and number of workers which fit in memory.
+    :param batch_sizes: (list[int]) batch sizes probed.
+    :param n_procs: (list[int]) numbers of workers probed, by default up to the number of CPUs.
+    :param memory_fraction: (float) fraction of the available memory which can be used.
+    :return: (DataFrame, dict) the results of all the probes, and the best batch_size and n_proc.
+    """
+    if n_procs is None:
+        n_procs = [n for n in [0, 2, 4, 8, 16] if n <= os.cpu_count()] + [os.cpu_count()]
+    # the largest number of workers is probed first, and the batch sizes in increasing order
+    batch_sizes, n_procs = sorted(set(batch_sizes)), sorted(set(n_procs))
+    memory_limit = memory_fraction * available_memory(model.device)
+
+    def probe(batch_size, n_proc):
+        try:
+            result = probe_settings(model, dataset, criterion, batch_size, n_proc, train, n_batches, amp)
+        except RuntimeError as error:  # torch.cuda.OutOfMemoryError is a RuntimeError
+            if "out of memory" not in str(error) and "can't allocate memory" not in str(error):
+                raise
+            result = {"samples_per_second": 0.0, "peak_memory_MiB": float("inf")}
+        finally:
+            if torch.device(model.device).type == "cuda":
+                torch.cuda.empty_cache()
+        probes.append({"batch_size": batch_size, "n_proc": n_proc, **result})
+        return result
+
+    probes = []
+    for batch_size in batch_sizes:
+        result = probe(batch_size, max(n_procs))
+        if result["peak_memory_MiB"] > memory_limit:
+            break
+        # The memory grows linearly with the batch size: stop before exceeding the limit
+        next_sizes = [size for size in batch_sizes if size > batch_size]
+        if next_sizes and result["peak_memory_MiB"] * next_sizes[0] / batch_size > memory_limit:
+            break
+
+    probes_df = pd.DataFrame(probes)
+    fitting_df = probes_df[probes_df.peak_memory_MiB <= memory_limit]
+    if len(fitting_df) == 0:
+        raise MemoryError(f"The smallest batch size ({batch_sizes[0]}) does not fit in memory.")
+    best_batch_size = int(fitting_df.loc[fitting_df.samples_per_second.idxmax(), "batch_size"])
+
+    for n_proc in n_procs[:-1]:
+        probe(best_batch_size, n_proc)
+    probes_df = pd.DataFrame(probes)
+    batch_df = probes_df[(probes_df.batch_size == best_batch_size) & (probes_df.peak_memory_MiB <= memory_limit)]
+    fast_df = batch_df[batch_df.samples_per_second >= 0.95 * batch_df.samples_per_second.max()]
+    best_n_proc = int(fast_df.n_proc.min())
+    return probes_df, {"batch_size": best_batch_size, "n_proc": best_n_proc}
+
+
+# %% [markdown]
+# The settings are written in the `[Computational]` section of a
+# configuration file of `clinicadl train`, given with the `-c` option (see the
+# [training notebook](./training.ipynb)). The network, the task and the data
+# are read from the same file and from the arguments of `clinicadl train`:
+# the CAPS, the JSON file of `prepare-data` and a TSV file of the training
+# set. An architecture set to `default` uses the default network of the task.
+
+# %%
+import toml
+
+from clinicadl.utils.caps_dataset.data import load_data_test, return_dataset
+from clinicadl.utils.task_manager.regression import RegressionManager
+from clinicadl.utils.task_manager.reconstruction import ReconstructionManager
+
+TASK_MANAGERS = {
+    "classification": ClassificationManager,
+    "regression": RegressionManager,
+    "reconstruction": ReconstructionManager,
+}
+DEFAULT_LABELS = {"classification": "diagnosis", "regression": "age"}
+
+
+def build_network(architecture, parameters, gpu=False):
+    """Builds a ClinicaDL network with the arguments found in parameters, as clinicadl train does."""
+    model_class = getattr(network_package, architecture)
+    init_code = model_class.__init__.__code__
+    kwargs = {
+        arg: parameters[arg]
+        for arg in init_code.co_varnames[1:init_code.co_argcount]
+        if arg in parameters
+    }
+    kwargs["gpu"] = gpu
+    return model_class(**kwargs)
+
+
+def write_computational_settings(config_path, settings):
+    """Writes settings in the [Computational] section of a TOML configuration file."""
+    config_path = Path(config_path)
+    config = toml.load(config_path) if config_path.is_file() else dict()
+    config.setdefault("Computational", dict()).update(settings)
+    with config_path.open("w") as f:
+        toml.dump(config, f)
+
+
+def autotune_config(
+    config_path,
+    task,
+    caps_directory,
+    preprocessing_json,
+    participants_tsv,
+    train=True,
+    gpu=False,
+    write=True,
+    **autotune_kwargs,
+):
+    """
+    Finds the best batch_size and n_proc of a clinicadl train configuration, and writes them in the file.
+    :param config_path: (Path) TOML configuration file given to clinicadl train.
+    :param task: (str) classification, regression or reconstruction.
+    :param participants_tsv: (Path) TSV file of the sessions sampled, for example the training set of a split.
+    :return: (DataFrame, dict) the results of all the probes, and the best settings.
+    """
+    config = toml.load(config_path) if Path(config_path).is_file() else dict()
+    task_config = config.get(task.capitalize(), dict())
+    data_config = config.get("Data", dict())
+    architecture = config.get("Model", dict()).get("architecture", "default")
+    amp = config.get("Computational", dict()).get("amp", False)
+    task_manager_class = TASK_MANAGERS[task]
+
+    caps_directory = Path(caps_directory)
+    preprocessing_dict = read_preprocessing(caps_directory / "tensor_extraction" / preprocessing_json)
+    df = load_data_test(Path(participants_tsv), data_config.get("diagnoses", ["AD", "CN"]))
+    label = task_config.get("label", DEFAULT_LABELS.get(task))
+    label_code = None
+    if task == "classification":
+        label_code = task_config.get("label_code") or ClassificationManager.generate_label_code(df, label)
+    train_transforms, all_transforms = get_transforms(
+        normalize=data_config.get("normalize", True),
+        data_augmentation=data_config.get("data_augmentation") or None,
+        size_reduction=data_config.get("size_reduction", False),
+        size_reduction_factor=data_config.get("size_reduction_factor", 2),
+    )
+    dataset = return_dataset(
+        caps_directory,
+        df,
+        preprocessing_dict,
+        all_transformations=all_transforms,
+        train_transformations=train_transforms,
+        label=label,
+        label_code=label_code,
+        label_presence=label is not None,
+    )
+
+    parameters = {
+        "input_size": list(dataset[0]["image"].shape),
+        "output_size": len(label_code) if task == "classification" else 1,
+        **config.get("Architecture", dict()),
+    }
+    if architecture == "default":
+        architecture = task_manager_class.get_default_network()
+    model = build_network(architecture, parameters, gpu=gpu)
+    criterion = task_manager_class.get_criterion(task_config.get("loss"))
+    probes_df, settings = autotune(model, dataset, criterion, train=train, amp=amp, **autotune_kwargs)
+    if write:
+        write_computational_settings(config_path, settings)
+    return probes_df, settings
+
+
+# %% [markdown]
+# The next cell tunes the training of the 2D slice-level CNN of the
+# [classification notebook](./training_classification.ipynb), and writes the
+# result in `data_oasis/train_config.toml`. Then, the training uses these
+# settings with `clinicadl train classification ... -c data_oasis/train_config.toml`.
+
+# %%
+with open("data_oasis/train_config.toml", "w") as f:
+    toml.dump({"Model": {"architecture": "resnet18"}, "Computational": {"gpu": torch.cuda.is_available()}}, f)
+
+probes_df, settings = autotune_config(
+    "data_oasis/train_config.toml",
+    "classification",
+    "data_oasis/CAPS_example",
+    "slice_classification_t1",
+    "data_oasis/split/4_fold/split-0/train_baseline.tsv",
+    gpu=torch.cuda.is_available(),
+)
+print(settings)
+probes_df
+
+# %% [markdown]
+# The prediction of a trained MAPS is tuned in the same way: the network, the
+# task and the data are read in its `maps.json`, and the sessions sampled are
+# the training set of its first split, or the sessions of a TSV file. The
+# memory needed without gradients is much smaller, so the best batch size is
+# larger. As `clinicadl predict` has no configuration file, pass the settings
+# with its `--batch_size` and `--n_proc` options:
+
+# %%
+def autotune_maps(maps_path, participants_tsv=None, caps_directory=None, train=False, gpu=False, **autotune_kwargs):
+    """
+    Finds the best batch_size and n_proc to predict with a MAPS (or to train it again if train is True).
+    :param participants_tsv: (Path) TSV file of the sessions sampled, by default the training set of the first split.
+    :param caps_directory: (Path) CAPS of participants_tsv, by default the CAPS of the training set.
+    :return: (DataFrame, dict) the results of all the probes, and the best settings.
+    """
+    maps_manager = MapsManager(Path(maps_path))
+    df, group_parameters = maps_manager.get_group_info("train", maps_manager._find_splits()[0])
+    multi_cohort = group_parameters["multi_cohort"]
+    if participants_tsv is not None:
+        df = load_data_test(Path(participants_tsv), maps_manager.diagnoses)
+        multi_cohort = False
+    train_transforms, all_transforms = get_transforms(
+        normalize=maps_manager.normalize,
+        data_augmentation=maps_manager.data_augmentation or None,
+        size_reduction=maps_manager.size_reduction,
+        size_reduction_factor=maps_manager.size_reduction_factor,
+    )
+    dataset = return_dataset(
+        Path(caps_directory or group_parameters["caps_directory"]),
+        df,
+        maps_manager.preprocessing_dict,
+        all_transformations=all_transforms,
+        train_transformations=train_transforms,
+        label=maps_manager.label,
+        label_code=maps_manager.label_code,
+        multi_cohort=multi_cohort,
+        label_presence=maps_manager.label is not None,
+    )
+    model = build_network(maps_manager.architecture, maps_manager.parameters, gpu=gpu)
+    criterion = maps_manager.task_manager.get_criterion(maps_manager.loss)
+    return autotune(model, dataset, criterion, train=train, amp=maps_manager.amp, **autotune_kwargs)
+
+
+_, predict_settings = autotune_maps(
+    "data_oasis/maps_classification_2D_slice_resnet18", gpu=torch.cuda.is_available()
+)
+print(f"clinicadl predict ... --batch_size {predict_settings['batch_size']} --n_proc {predict_settings['n_proc']}")
+
+# %% [markdown]
+# ```{note}
+# On CPU, the memory measured is the one of the main process: the memory used
+# by the workers, which hold the batches being prepared, is not included, so
+# keep a margin with `memory_fraction`. Also remember that the batch size
+# changes the optimization: with a much larger batch size, the learning rate
+# may need to be adapted. Use `batch_sizes` to restrict the values probed.
+# ```
@@ -361,6 +361,13 @@ print('GPU is available', torch.cuda.is_available())
 # With autoencoder pretraining
 !clinicadl train classification data_adni/CAPS_example pet_reconstruction data_adni/split/4_fold data_adni/maps_classification_transfer_AE_patch_multi --architecture Conv4_FC3 --transfer_path data_adni/maps_reconstrcution_patch --n_splits 4 --epochs 3 --multi-network
 
+# %% [markdown]
+# ```{tip}
+# A 3D-patch multi-CNN trains one CNN per patch location, one after the other.
+# To train all of them in a single loop, see the
+# [speed up the training](./training_performance.ipynb) notebook.
+# ```
+
 # %% [markdown]
 # The clinicadl train command outputs a MAPS structure in which there are only
 # two data groups: train and validation.  A MAPS folder contains all the